@@ -0,0 +1,213 @@
+"""
+額度滿載時的排隊 (admission control)：所有 Key 都回 429 (或都在冷卻、斷路器斷開) 時，
+這一輪不再直接失敗、讓學員自己一直重送，而是排進佇列；額度一恢復就依序送出。
+
+    queue = admission.get_queue(api_keys)
+    ticket = admission.Ticket(user_id)
+    reply = await queue.run(ticket, lambda: sim.send(text), retry=lambda: sim.reply())
+
+公平性：每位學員一個佇列，輪流 (round-robin) 送出，同一位學員連續送很多則也不會插到別人前面；
+有人在排隊時，新來的請求也排在後面，不會直接衝去搶剛恢復的額度。
+ticket.position / queue.eta(ticket) 可在其他執行緒讀取，給畫面顯示「排在第幾位、大約還要等多久」。
+排隊的人數超過 MAX_QUEUE_DEPTH 時直接丟出 QueueFull，等超過 MAX_WAIT 秒丟出 QueueTimeout。
+
+用同一組 Key 的學員共用一個佇列 (每位學員各自帶 Key 時互不影響)。
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import chat_engine
+import key_registry
+
+MAX_QUEUE_DEPTH = int(os.environ.get("ADMISSION_MAX_DEPTH", "50"))  # 同一組 Key 最多幾則在排隊
+MAX_WAIT = 180.0            # 排隊最多等多久 (秒)
+RETRY_MIN = 2.0             # 額度滿載後多久再試 (秒)，連續滿載時加倍
+RETRY_MAX = 30.0
+DEFAULT_SERVICE_SECONDS = 5.0  # 還沒有量到時，假設一則要多久 (估計等待時間用)
+
+
+class QueueFull(RuntimeError):
+    """排隊的人數已達上限"""
+
+
+class QueueTimeout(TimeoutError):
+    """排隊超過 MAX_WAIT 仍沒有輪到"""
+
+
+def is_saturated(exc):
+    """這個錯誤代表額度滿載 (應該排隊重試)，而不是這則訊息本身的問題"""
+    return isinstance(exc, chat_engine.NoKeyAvailable) or chat_engine.is_quota_error(exc)
+
+
+class Ticket:
+    """一則排隊中的訊息；position 為 0 表示沒有在排隊 (還沒排、已送出或已結束)"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.position = 0
+        self.attempt = None
+        self.retry = None
+        self.future = None
+
+
+class AdmissionQueue:
+    def __init__(self, api_keys=(), max_depth=MAX_QUEUE_DEPTH, max_wait=MAX_WAIT):
+        self.api_keys = list(api_keys)
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.retry_at = 0.0              # 額度預計恢復的時間 (time.monotonic())
+        self.service_seconds = DEFAULT_SERVICE_SECONDS
+        self.shed = 0                    # 因為排隊已滿而拒絕的次數
+        self._backoff = RETRY_MIN
+        self._queues = OrderedDict()     # user_id → deque[Ticket]，排在前面的學員先輪到
+        self._depth = 0
+        self._lock = threading.Lock()    # 畫面會從其他執行緒讀取排隊位置
+        self._dispatcher = None
+
+    def __len__(self):
+        return self._depth
+
+    async def run(self, ticket, attempt, retry=None):
+        """
+        執行 attempt() (回傳 coroutine)。額度滿載時排隊，輪到時改執行 retry() (預設同 attempt)；
+        其他錯誤照常往外丟。
+        """
+        ticket.attempt, ticket.retry = attempt, retry or attempt
+        if not self._depth and time.monotonic() >= self.retry_at:
+            try:
+                return await attempt()
+            except Exception as e:
+                if not is_saturated(e):
+                    raise
+                await self._saturate()
+            ticket.attempt = ticket.retry
+        return await self._wait(ticket)
+
+    async def _wait(self, ticket):
+        with self._lock:
+            if self._depth >= self.max_depth:
+                self.shed += 1
+                raise QueueFull(f"目前已有 {self._depth} 則訊息在排隊")
+            ticket.future = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(ticket.user_id, deque()).append(ticket)
+            self._depth += 1
+            self._renumber()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            return await asyncio.wait_for(asyncio.shield(ticket.future), self.max_wait)
+        except asyncio.TimeoutError:
+            if self._remove(ticket):
+                raise QueueTimeout(f"排隊超過 {self.max_wait:.0f} 秒") from None
+            return await ticket.future  # 已經輪到、正在送出：等它完成
+        except asyncio.CancelledError:
+            self._remove(ticket)
+            raise
+
+    def _remove(self, ticket):
+        with self._lock:
+            queue = self._queues.get(ticket.user_id)
+            if queue is None or ticket not in queue:
+                return False
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user_id]
+            self._depth -= 1
+            ticket.position = 0
+            self._renumber()
+            return True
+
+    def _renumber(self):
+        """依輪流的順序重新計算每則的排隊位置 (第 1 輪是每位學員的第一則，依此類推)"""
+        position = 0
+        queues = list(self._queues.values())
+        for round_index in range(max((len(q) for q in queues), default=0)):
+            for queue in queues:
+                if round_index < len(queue):
+                    position += 1
+                    queue[round_index].position = position
+
+    def _pop_next(self):
+        with self._lock:
+            if not self._queues:
+                return None
+            user_id, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            del self._queues[user_id]
+            if queue:
+                self._queues[user_id] = queue  # 這位學員還有下一則：排到最後面
+            self._depth -= 1
+            ticket.position = 0
+            self._renumber()
+            return ticket
+
+    def _push_front(self, ticket):
+        with self._lock:
+            queue = self._queues.setdefault(ticket.user_id, deque())
+            queue.appendleft(ticket)
+            self._queues.move_to_end(ticket.user_id, last=False)
+            self._depth += 1
+            self._renumber()
+
+    async def _saturate(self):
+        """額度滿載：等到最快恢復的 Key 冷卻結束 (至少等 _backoff 秒，連續滿載時加倍)"""
+        registry = key_registry.get_registry()
+        # 登記後端是 SQLite / Redis：在執行緒池中查詢，不佔用事件迴圈
+        cooldown = await asyncio.to_thread(
+            lambda: min((registry.cooldown_left(key) for key in self.api_keys), default=0.0))
+        self.retry_at = time.monotonic() + max(cooldown, self._backoff)
+        self._backoff = min(self._backoff * 2, RETRY_MAX)
+
+    async def _dispatch(self):
+        """一次送出一則；額度滿載時把那一則放回最前面，等恢復後再試"""
+        while True:
+            delay = self.retry_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            ticket = self._pop_next()
+            if ticket is None:
+                return
+            if ticket.future.done():
+                continue
+            started = time.monotonic()
+            try:
+                result = await ticket.attempt()
+            except Exception as e:
+                if is_saturated(e) and not ticket.future.done():
+                    ticket.attempt = ticket.retry
+                    self._push_front(ticket)
+                    await self._saturate()
+                elif not ticket.future.done():
+                    ticket.future.set_exception(e)
+                continue
+            self._backoff = RETRY_MIN
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * (time.monotonic() - started)
+            if not ticket.future.done():
+                ticket.future.set_result(result)
+
+    def eta(self, ticket):
+        """估計還要等幾秒才輪到 (沒有在排隊時為 0)"""
+        if not ticket.position:
+            return 0.0
+        return max(0.0, self.retry_at - time.monotonic()) + (ticket.position - 1) * self.service_seconds
+
+    def stats(self):
+        with self._lock:
+            return {"queued": self._depth, "users": len(self._queues), "shed": self.shed,
+                    "retry_in": max(0.0, self.retry_at - time.monotonic())}
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(api_keys):
+    """用這組 Key 的共用佇列 (同一組 Key 不論順序都是同一個)"""
+    pool = frozenset(api_keys)
+    with _queues_lock:
+        if pool not in _queues:
+            _queues[pool] = AdmissionQueue(api_keys)
+        return _queues[pool]
@@ -0,0 +1,426 @@
+"""
+模擬器的 HTTP API (不經過 streamlit)：給 LMS 外掛、行動裝置等其他前端使用，可以獨立於網頁版擴充。
+
+    GEMINI_API_KEYS=key1,key2 python api_server.py --port 8080
+
+所有學員共用同一個 event loop、同一份教材與同一組 API Key；每場演練是一個 engine.ConversationSession。
+
+端點 (請求與回應都是 JSON)：
+    POST   /sessions                  開新個案 {"user_id", "grade", "lang", "session_num", "relation", "recent_event", "variant"}
+                                      → {"session_id", "persona", "reply"} (reply 為學生的開場白)
+    POST   /sessions/resume           續談 {"user_id", "lang", "variant", 以及 "session_file" (續談檔內容) 或 "record_id" (自己的雲端紀錄編號)}
+    POST   /sessions/{id}/turns       老師送出一則訊息 {"text"} → {"reply"}
+    GET    /sessions/{id}             對話紀錄 (?format=jsonl 時回傳續談檔)
+    DELETE /sessions/{id}             結束演練 (最後存檔一次)
+    GET    /healthz                   服務狀態
+
+"variant" (A/B 分流) 可省略，省略時依學員編號按權重分配 (見 cohorts.py)。
+
+開場白與送出訊息都可以加 ?stream=1 (或 Accept: text/event-stream) 改用 SSE 串流：
+學生回應每生成一段送一個 "chunk" 事件，結束時送 "done" (內容同非串流的回應) 或 "error"。
+所有 Key 額度滿載時請求會排隊 (見 admission.py)，排隊期間位置有變就送一個 "queued" 事件 {"position", "eta_seconds"}。
+
+環境變數：
+    GEMINI_API_KEYS       必填，多組用逗號隔開
+    GEMINI_MODEL          預設 gemini-2.5-flash
+    GCP_SERVICE_ACCOUNT   研究資料庫的服務帳戶憑證檔 (JSON)；沒有設定時不存檔，也不能從雲端紀錄續談
+    SIM_API_TOKEN         有設定時，請求必須帶 "Authorization: Bearer <token>"
+    SESSION_STORE         演練狀態的共用後端 (見 session_store.py)；設定後多個副本可共用演練、重啟也不會中斷
+    SESSION_IDLE_MINUTES  閒置多久的演練移到磁碟暫存 (見 idle_sessions.py)，預設 30
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+import admission
+import chat_engine
+import cohorts
+import corpus
+import engine
+import idle_sessions
+import personas
+import session_io
+import session_store
+import sheets_store
+
+
+def _error_status(exc):
+    """引擎的錯誤轉成 (HTTP 狀態碼, 提示訊息)；不認得的錯誤回傳 None"""
+    if isinstance(exc, chat_engine.TurnDeadlineExceeded):
+        return 504, "學生這次想太久了 (連線逾時)，請再送出一次試試看。"
+    if isinstance(exc, chat_engine.NoKeyAvailable):
+        return 503, "目前所有 API Key 都在短暫休息中 (連續發生狀況)，請稍等 30 秒後再試。"
+    if chat_engine.is_quota_error(exc):
+        return 429, "目前所有 API 額度都耗盡了，請稍等 1 分鐘後再試。"
+    if isinstance(exc, admission.QueueFull):
+        return 429, "目前排隊的人太多，API 額度都用滿了，請稍等 1 分鐘後再試。"
+    if isinstance(exc, admission.QueueTimeout):
+        return 503, "排隊等太久了，目前所有 API 額度都耗盡了，請稍等 1 分鐘後再試。"
+    return None
+
+
+def _json_error(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+async def _read_json(request):
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise web.HTTPBadRequest(text="請求內容不是有效的 JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="請求內容必須是 JSON 物件")
+    return body
+
+
+def _require(body, name):
+    value = str(body.get(name) or "").strip()
+    if not value:
+        raise web.HTTPBadRequest(text=f"缺少 {name}")
+    return value
+
+
+def _choice(body, name, choices):
+    value = body.get(name) or choices[0]
+    if value not in choices:
+        raise web.HTTPBadRequest(text=f"{name} 必須是 {'、'.join(choices)} 其中之一")
+    return value
+
+
+def _wants_stream(request):
+    return request.query.get("stream") in ("1", "true") or "text/event-stream" in request.headers.get("Accept", "")
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _transcript(session_id, sim):
+    return {
+        "session_id": session_id,
+        "user_id": sim.user_id,
+        "persona": sim.persona,
+        "turns": sim.turns,
+        "start_time": sim.start_time.isoformat(timespec="seconds"),
+    }
+
+
+class SimulatorService:
+    """
+    API 的狀態：共用的教材與發送設定，以及進行中的演練 (idle_sessions.SessionPool，閒置的會移到磁碟)
+    與各場的回合鎖 (session_id → asyncio.Lock)
+    """
+
+    def __init__(self, api_keys, model_name=engine.DEFAULT_MODEL, hedge=False, saver=None, creds_dict=None,
+                 store=None, spill=None):
+        self.api_keys = api_keys
+        self.model_name = model_name
+        self.hedge = hedge
+        self.saver = saver
+        self.creds_dict = creds_dict
+        self.store = store
+        self.corpus_loader = None
+        self.sessions = idle_sessions.SessionPool(spill, on_restore=self._configure)
+        self._locks = {}
+        self._next_key = itertools.count()  # 各場演練從不同的 Key 開始輪替，分散負載
+        self._save_tasks = set()
+
+    @property
+    def knowledge(self):
+        """目前讀到的教材 (背景還在讀時是前段，讀完後是全文)"""
+        return self.corpus_loader.text() if self.corpus_loader is not None else ""
+
+    def _register(self, sim, checkpoint=True):
+        sim.configure(model_name=self.model_name, hedge=self.hedge, key_index=next(self._next_key) % len(self.api_keys))
+        session_id = uuid.uuid4().hex
+        self._attach(session_id, sim)
+        if checkpoint:
+            self._save_later(session_id, sim, research=False)
+        return session_id
+
+    def _configure(self, sim):
+        return sim.configure(api_keys=self.api_keys, saver=self.saver)
+
+    def _attach(self, session_id, sim):
+        self.sessions.put(session_id, self._configure(sim))
+        return sim, self._locks.setdefault(session_id, asyncio.Lock())
+
+    async def _get(self, request):
+        session_id = request.match_info["session_id"]
+        # 還在記憶體中的直接取用；閒置太久移到磁碟的演練，在背景執行緒接回 (讀 SQLite 與解壓縮不佔用事件迴圈)
+        if session_id in self.sessions:
+            sim = self.sessions.get(session_id)
+        else:
+            sim = await asyncio.to_thread(self.sessions.get, session_id)
+        if self.store is not None:
+            # 可能是別的副本開的演練、本程序重啟過，或別的副本處理了較新的回合：以共用後端較新的狀態為準
+            state = await asyncio.to_thread(self.store.load, session_id)
+            if state and (sim is None or len(state["turns"]) > len(sim.conversation)):
+                return self._attach(session_id, engine.ConversationSession.from_state(state))
+        if sim is None:
+            raise web.HTTPNotFound(text="找不到這場演練 (可能已經結束)")
+        return sim, self._locks.setdefault(session_id, asyncio.Lock())
+
+    async def evict_idle(self):
+        """把閒置的演練移到磁碟 (正在等學生回應的不動)"""
+        def busy(session_id):
+            lock = self._locks.get(session_id)
+            return lock is not None and lock.locked()
+
+        for session_id in await asyncio.to_thread(self.sessions.evict_idle, busy):
+            if not busy(session_id):
+                self._locks.pop(session_id, None)
+
+    def _save_later(self, session_id, sim, research=True):
+        # 存檔在背景進行，不拖慢回應；保留 task 的參照，避免執行到一半被回收
+        task = asyncio.create_task(self._persist(session_id, sim.to_state(), sim if research else None))
+        self._save_tasks.add(task)
+        task.add_done_callback(self._save_tasks.discard)
+
+    async def _persist(self, session_id, state, sim=None):
+        if self.store is not None:
+            await asyncio.to_thread(self.store.save, session_id, state)
+        if sim is not None:
+            await sim.save()
+
+    async def _respond(self, request, session_id, sim, run, extra=None, retry=None):
+        """
+        執行一輪 (開場或回應)；依請求回傳 JSON 或 SSE 串流。
+        額度滿載時排隊，輪到時改執行 retry (預設同 run)。
+        """
+        extra = extra or {}
+        ticket = admission.Ticket(sim.user_id)
+        admission_queue = admission.get_queue(self.api_keys)
+
+        def admitted(on_chunk):
+            return admission_queue.run(ticket, lambda: run(on_chunk), (lambda: retry(on_chunk)) if retry else None)
+
+        if not _wants_stream(request):
+            try:
+                reply = await admitted(None)
+            except Exception as e:
+                error = _error_status(e)
+                if error is None:
+                    raise
+                return _json_error(*error)
+            self._save_later(session_id, sim)
+            return web.json_response({**extra, "reply": reply})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        task = asyncio.create_task(admitted(queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        position = 0
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(queue.get(), 1.0)
+                except asyncio.TimeoutError:
+                    if ticket.position and ticket.position != position:
+                        position = ticket.position
+                        await response.write(_sse("queued", {"position": position,
+                                                             "eta_seconds": round(admission_queue.eta(ticket))}))
+                    continue
+                if chunk is None:
+                    break
+                await response.write(_sse("chunk", {"text": chunk}))
+            try:
+                reply = task.result()
+            except Exception as e:
+                status, message = _error_status(e) or (500, f"發生嚴重錯誤: {e}")
+                await response.write(_sse("error", {"status": status, "error": message}))
+            else:
+                self._save_later(session_id, sim)
+                await response.write(_sse("done", {**extra, "reply": reply}))
+            await response.write_eof()
+        finally:
+            # 前端中途斷線時，不再繼續生成
+            if not task.done():
+                task.cancel()
+        return response
+
+    async def create_session(self, request):
+        body = await _read_json(request)
+        try:
+            session_num = int(body.get("session_num") or personas.DEFAULT_SESSION_NUM)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="session_num 必須是整數")
+        user_id = _require(body, "user_id")
+        sim = engine.ConversationSession.new_case(
+            user_id, self.knowledge,
+            _choice(body, "grade", personas.GRADES), _choice(body, "lang", personas.LANGUAGES),
+            session_num=session_num,
+            relation=_choice(body, "relation", personas.RELATIONS),
+            recent_event=str(body.get("recent_event") or personas.DEFAULT_RECENT_EVENT),
+            variant=cohorts.resolve(body.get("variant"), user_id),
+        )
+        # 開場白成功後 _respond 才會存檔；失敗時回應中沒有 session_id，前端無從續用或結束，直接丟掉這場
+        session_id = self._register(sim, checkpoint=False)
+        lock = self._locks[session_id]
+        async with lock:
+            try:
+                return await self._respond(request, session_id, sim, lambda on_chunk: sim.start(on_chunk=on_chunk),
+                                           {"session_id": session_id, "persona": sim.persona})
+            finally:
+                if not len(sim.conversation):
+                    self._locks.pop(session_id, None)
+                    await asyncio.to_thread(self.sessions.pop, session_id)
+
+    async def resume_session(self, request):
+        body = await _read_json(request)
+        user_id = _require(body, "user_id")
+        lang = _choice(body, "lang", personas.LANGUAGES)
+        try:
+            if body.get("session_file"):
+                persona, turns = session_io.load_session(str(body["session_file"]).encode("utf-8"),
+                                                         body.get("filename") or "session.jsonl")
+            elif body.get("record_id"):
+                if self.creds_dict is None:
+                    return _json_error(501, "伺服器沒有設定研究資料庫，無法從雲端紀錄續談")
+                persona, turns = await asyncio.to_thread(self._fetch_record, str(body["record_id"]), user_id)
+            else:
+                raise web.HTTPBadRequest(text="請提供 session_file 或 record_id")
+        except ValueError as e:
+            return _json_error(400, str(e))
+        sim = engine.ConversationSession.resume(user_id, persona, turns, self.knowledge, lang,
+                                                variant=cohorts.resolve(body.get("variant"), user_id))
+        return web.json_response(_transcript(self._register(sim), sim))
+
+    def _fetch_record(self, record_id, user_id):
+        """只能載入這位學員自己的紀錄"""
+        worksheet = sheets_store.connect(self.creds_dict)
+        matches = sheets_store.find_sessions(worksheet, record_id, user_id=user_id)
+        if not matches:
+            raise web.HTTPNotFound(text="找不到這個編號的紀錄 (只能載入自己的紀錄)")
+        return sheets_store.fetch_session(worksheet, matches[0][2])
+
+    async def send_turn(self, request):
+        sim, lock = await self._get(request)
+        text = _require(await _read_json(request), "text")
+        if lock.locked():
+            return _json_error(409, "上一則訊息還在等學生回應，請稍候再送出")
+        async with lock:
+            return await self._respond(request, request.match_info["session_id"], sim,
+                                       lambda on_chunk: sim.send(text, on_chunk=on_chunk),
+                                       retry=lambda on_chunk: sim.reply(on_chunk=on_chunk))
+
+    async def get_transcript(self, request):
+        sim, _ = await self._get(request)
+        if request.query.get("format") == "jsonl":
+            saved_at = (datetime.now() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
+            body = session_io.dump_session_jsonl(sim.turns, sim.persona, sim.user_id, saved_at)
+            return web.Response(body=body, content_type="application/jsonl")
+        return web.json_response(_transcript(request.match_info["session_id"], sim))
+
+    async def end_session(self, request):
+        sim, lock = await self._get(request)
+        async with lock:
+            await asyncio.to_thread(self.sessions.pop, request.match_info["session_id"])
+            self._locks.pop(request.match_info["session_id"], None)
+            if self.store is not None:
+                await asyncio.to_thread(self.store.delete, request.match_info["session_id"])
+            saved = await sim.save()
+        return web.json_response({"saved": saved})
+
+    async def healthz(self, request):
+        return web.json_response({
+            "sessions": len(self.sessions),
+            "session_pool": await asyncio.to_thread(self.sessions.stats),
+            "admission": admission.get_queue(self.api_keys).stats(),
+            "knowledge_chars": len(self.knowledge),
+            "knowledge_loading": self.corpus_loader is not None and not self.corpus_loader.done,
+            "api_keys": len(self.api_keys),
+            "model": self.model_name,
+        })
+
+
+def create_app(service, pdf_glob="*.pdf", token=None):
+    @web.middleware
+    async def auth(request, handler):
+        if token and request.path != "/healthz" and request.headers.get("Authorization") != f"Bearer {token}":
+            return _json_error(401, "未授權")
+        try:
+            return await handler(request)
+        except web.HTTPClientError as e:
+            return _json_error(e.status, e.text)
+
+    async def load_knowledge(app):
+        # 教材只讀一次，所有學員共用；讀到夠放進 Prompt 的字數就開始接受請求，其餘在背景繼續讀
+        loader = corpus.get_shared_loader(pdf_glob)
+        await asyncio.to_thread(loader.wait, personas.KNOWLEDGE_CHAR_LIMIT)
+        service.corpus_loader = loader
+
+    async def warm_clients(app):
+        # 每把 Key 的連線在啟動時先建好，第一位學員不必等連線
+        await chat_engine.clients.warm_up(service.api_keys, service.model_name)
+
+    async def reap_idle():
+        while True:
+            await asyncio.sleep(idle_sessions.REAP_INTERVAL)
+            try:
+                await service.evict_idle()
+            except Exception as e:
+                print(f"閒置演練清理失敗: {e}")
+
+    async def start_reaper(app):
+        if service.sessions.spill is not None:
+            app["reaper"] = asyncio.create_task(reap_idle())
+
+    async def flush_saves(app):
+        if "reaper" in app:
+            app["reaper"].cancel()
+        if service._save_tasks:
+            await asyncio.gather(*service._save_tasks, return_exceptions=True)
+
+    app = web.Application(middlewares=[auth])
+    app.on_startup.append(load_knowledge)
+    app.on_startup.append(warm_clients)
+    app.on_startup.append(start_reaper)
+    app.on_cleanup.append(flush_saves)
+    app.add_routes([
+        web.post("/sessions", service.create_session),
+        web.post("/sessions/resume", service.resume_session),
+        web.post("/sessions/{session_id}/turns", service.send_turn),
+        web.get("/sessions/{session_id}", service.get_transcript),
+        web.delete("/sessions/{session_id}", service.end_session),
+        web.get("/healthz", service.healthz),
+    ])
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="創傷知情模擬器 HTTP API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model", default=os.environ.get("GEMINI_MODEL", engine.DEFAULT_MODEL))
+    parser.add_argument("--hedge", action="store_true", help="開啟備援加速 (需要兩把以上 Key)")
+    parser.add_argument("--pdf-glob", default="*.pdf", help="教材 PDF 的路徑樣式")
+    args = parser.parse_args(argv)
+
+    api_keys = chat_engine.env_api_keys()
+    if not api_keys:
+        return 1
+    creds_dict = None
+    if os.environ.get("GCP_SERVICE_ACCOUNT"):
+        with open(os.environ["GCP_SERVICE_ACCOUNT"], encoding="utf-8") as f:
+            creds_dict = json.load(f)
+
+    service = SimulatorService(
+        api_keys, model_name=args.model, hedge=args.hedge and len(api_keys) > 1,
+        saver=sheets_store.make_saver(creds_dict) if creds_dict else None, creds_dict=creds_dict,
+        store=session_store.get_store(), spill=idle_sessions.open_spill(),
+    )
+    web.run_app(create_app(service, args.pdf_glob, os.environ.get("SIM_API_TOKEN")), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
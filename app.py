@@ -1,175 +1,180 @@
 import streamlit as st
 import os
-import random
-import glob
-import pandas as pd
 import json
+import concurrent.futures
 from datetime import datetime, timedelta
-from pypdf import PdfReader
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import time
+
+import admission
+import chat_engine
+import cohorts
+import corpus
+import engine
+import idle_sessions
+import key_registry
+import model_policy
+import personas
+import response_cache
+import session_io
+import session_store
+import sheets_store
+
+# 💡 pandas / pypdf / google.generativeai / gspread / oauth2client 都改為「用到才載入」，
+#    登入畫面只需要 streamlit，新學員第一次打開頁面不必等這些大型套件。
+#    各模組的載入時間可用 `python bench_startup.py` 量測。
 
 # --- 1. 系統設定 ---
-st.set_page_config(page_title="創傷知情模擬器 (研究完全版)", layout="wide")
+# A/B 分流：舊入口 simulator_A.py / simulator_B.py 會固定 FORCED_VARIANT；
+# 直接執行 app.py 時依網址 ?variant= 指定，或登入後依學員編號按權重分配 (見 cohorts.py)
+FORCED_VARIANT = globals().get("FORCED_VARIANT")
+requested_variant = FORCED_VARIANT or st.query_params.get("variant")
+st.set_page_config(page_title=cohorts.page_title(st.session_state.get("variant") or requested_variant), layout="wide")
+
+# --- Google Sheets 背景自動上傳 (Auto-Save 版) ---
+def get_research_worksheet():
+    return sheets_store.connect(st.secrets["gcp_service_account"])
 
-# --- Google Sheets 背景自動上傳函式 (Auto-Save 版) ---
-def auto_save_to_google_sheets(user_id, chat_history):
-    """每次對話更新時，自動在背景覆寫/更新該次對話紀錄"""
-    if not chat_history:
+def research_sheet_configured():
+    """有沒有設定研究資料庫的憑證 (沒有 secrets 檔時 st.secrets 會直接丟錯)"""
+    try:
+        return "gcp_service_account" in st.secrets
+    except Exception:
         return False
-        
+
+def research_saver():
+    """每次對話更新時，自動在背景覆寫/更新該次對話紀錄 (沒有設定雲端憑證時不存檔)"""
     try:
-        # 1. 連線與設定
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        if "private_key" in creds_dict:
-            creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
-        
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        
-        # 2. 開啟試算表
-        sheet = client.open("2025創傷知情研習數據") 
-        worksheet = sheet.worksheet("Simulator")
-        
-        # 3. 準備資料
-        tw_fix = timedelta(hours=8)
-        start_t = st.session_state.get('start_time', datetime.now())
-        login_str = (start_t + tw_fix).strftime("%Y-%m-%d %H:%M:%S")
-        end_t = datetime.now()
-        logout_str = (end_t + tw_fix).strftime("%Y-%m-%d %H:%M:%S") # 視為最後更新時間
-        duration_mins = round((end_t - start_t).total_seconds() / 60, 2)
-        
-        # 建立專屬的 Session ID (用登入時間標記這回合對話)
-        session_id = f"{user_id}_{login_str}"
-        
-        # 4. 整理對話內容
-        scenario = st.session_state.get("current_persona", {})
-        basic_info = f"角色:{scenario.get('name','未知')}/觸發:{scenario.get('trigger','未知')}"
-        adv_info = f"第{scenario.get('session_num',1)}次/關係:{scenario.get('relation','未知')}/前情:{scenario.get('recent_event','無')}"
-        scenario_str = f"{basic_info} | {adv_info}"
-        
-        full_conversation = f"【演練案例】：{scenario_str}\n\n"
-        for msg in chat_history:
-            role = msg.get("role", "Unknown")
-            content = ""
-            if "parts" in msg:
-                content = msg["parts"][0] if isinstance(msg["parts"], list) else str(msg["parts"])
-            elif "content" in msg:
-                content = msg["content"]
-            full_conversation += f"[{role}]: {content}\n"
-
-        # 5. 尋找並更新，或新增一筆
-        records = worksheet.get_all_records()
-        row_to_update = None
-        col_logins = worksheet.col_values(1) # 第一欄：登入時間
-        col_ids = worksheet.col_values(3)    # 第三欄：學員編號
-        
-        for i in range(1, len(col_logins)): # 跳過標題列
-            if i < len(col_ids) and col_logins[i] == login_str and str(col_ids[i]) == str(user_id):
-                row_to_update = i + 1 # Gspread 索引從 1 開始
-                break
-                
-        # 計算累積次數
-        login_count = col_ids.count(str(user_id))
-        if row_to_update is None:
-            login_count += 1 # 新增一筆
-            
-        data_row = [login_str, logout_str, user_id, duration_mins, login_count, full_conversation]
-        
-        if row_to_update:
-            # 更新既有列 (A:F)
-            cell_range = f'A{row_to_update}:F{row_to_update}'
-            worksheet.update(cell_range, [data_row])
-        else:
-            # 新增一列
-            worksheet.append_row(data_row)
-            
-        return True
+        return sheets_store.make_saver(dict(st.secrets["gcp_service_account"]))
     except Exception as e:
         print(f"背景上傳失敗: {e}") # 背景報錯不干擾使用者
-        return False
+        return None
+
+# --- 演練引擎 (engine.py)：對話紀錄與個案設定直接指向引擎中的同一份資料 ---
+# 引擎物件放在整個程序共用的演練池 (idle_sessions.py)，session_state 只記編號：
+# 分頁關掉沒有結束的演練，閒置一段時間後會移到磁碟，不會一直佔著記憶體；學員回來時自動接回
+def current_sim():
+    if not st.session_state.session_id:
+        return None
+    return idle_sessions.get_pool().get(st.session_state.session_id)
+
+def start_session(sim):
+    idle_sessions.get_pool().put(st.session_state.session_id, sim)
+    st.session_state.current_persona = sim.persona
+    st.session_state.export_cache = None
+    st.session_state.chat_session_initialized = True
+    checkpoint()
+
+# --- 多副本部署：學員狀態存到共用的後端 (有設定 SESSION_STORE 時)，換副本或重新連線時由網址的 ?sid= 接回 ---
+def checkpoint():
+    store = session_store.get_store()
+    if store is None or not st.session_state.session_id:
+        return
+    sim = current_sim()
+    store.save(st.session_state.session_id, {
+        "user_nickname": st.session_state.user_nickname,
+        "variant": st.session_state.variant,
+        "start_time": st.session_state.start_time.isoformat(),
+        "sim": sim.to_state() if sim else None,
+    })
+
+def restore_checkpoint(session_id, state):
+    st.session_state.session_id = session_id
+    st.session_state.user_nickname = state["user_nickname"]
+    st.session_state.variant = state.get("variant")
+    st.session_state.start_time = datetime.fromisoformat(state["start_time"])
+    if state.get("sim"):
+        sim = engine.ConversationSession.from_state(state["sim"])
+        st.session_state.current_key_index = sim.key_index
+        start_session(sim)
 
 # --- API 輪替與防呆發送機制 (角色強化版) ---
-def send_message_safely(text):
+def send_message_safely(text=None):
     """
-    發送訊息，若失敗則自動切換至下一把 API Key 重試。
-    加入 system_instruction 防護機制，確保切換 Key 時學生角色絕不突變。
+    透過演練引擎發送訊息，若失敗則自動切換至下一把 API Key 重試。
+    引擎以 system_instruction 鎖定角色設定，確保切換 Key 時學生角色絕不突變。
+    text 為 None 時請學生先開場。成功回傳學生回應 {"role", "content", "model"}，失敗時顯示提示並回傳 None。
     """
-    time.sleep(1) # [防呆] 強制減速 1 秒
+    sim = current_sim()
+    sim.configure(
+        api_keys=st.session_state.api_keys_list,
+        model_name=st.session_state.valid_model_name,
+        hedge=st.session_state.use_hedging,
+        model_fallback=st.session_state.use_model_fallback,
+        use_cache=st.session_state.use_response_cache,
+        key_index=st.session_state.current_key_index,
+        saver=research_saver(),
+    )
+    sim.start_time = st.session_state.start_time
     
-    # --- 關鍵修改 1：分離 System Prompt 與一般對話歷史 ---
-    # 我們的設計中，history 的第一筆 [0] 永遠是學生的角色設定 (sys_prompt)
-    system_prompt = st.session_state.history[0]["content"]
+    # 引擎在背景執行緒中執行，st.toast 要回到這裡才能顯示
+    failed_keys = []
+    def on_key_error(key_index, e):
+        failed_keys.append(key_index)
     
-    # 取得除了第一筆 (sys_prompt) 之外的純對話歷史
-    gemini_history = []
-    for msg in st.session_state.history[1:]:
-        g_role = "model" if msg["role"] == "assistant" else "user"
-        gemini_history.append({"role": g_role, "parts": [msg["content"]]})
-        
-    api_keys = st.session_state.api_keys_list
-    total_keys = len(api_keys)
+    # 開始輪替嘗試：每次嘗試與整輪都有時限，連續失敗的 Key 會暫時跳過
+    # (開啟備援加速時，太慢的請求會改用另一把 Key 同時再送一次)
+    # 所有 Key 額度都滿載時不直接失敗，改為排隊 (admission.py)，額度恢復後依序送出；排隊期間顯示位置與預估時間
+    queue = admission.get_queue(st.session_state.api_keys_list)
+    ticket = admission.Ticket(st.session_state.user_nickname)
+    if text is None:
+        attempt = retry = lambda: sim.start(on_key_error)
+    else:
+        attempt, retry = (lambda: sim.send(text, on_key_error)), (lambda: sim.reply(on_key_error))
+    future = engine.submit(queue.run(ticket, attempt, retry))
+    queue_notice = st.empty()
+    try:
+        while True:
+            try:
+                reply = future.result(timeout=1.0)
+                break
+            except concurrent.futures.TimeoutError:
+                if ticket.position:
+                    queue_notice.info(f"🚦 目前 API 額度滿載，正在排隊：您是第 {ticket.position} 位，"
+                                      f"預計約 {queue.eta(ticket):.0f} 秒後輪到您，請不要重新送出。")
+    except chat_engine.TurnDeadlineExceeded:
+        st.warning("⏳ 學生這次想太久了 (連線逾時)，請再送出一次試試看。")
+        return None
+    except admission.QueueFull:
+        st.warning("🐌 哎呀！目前排隊的人太多，API 額度都用滿了。請稍等 1 分鐘後再試喔！")
+        return None
+    except admission.QueueTimeout:
+        st.warning("🐌 哎呀！排隊等太久了，目前所有 API 額度都耗盡了。請稍等 1 分鐘後再試喔！")
+        return None
+    finally:
+        queue_notice.empty()
+        for key_index in failed_keys:
+            st.toast(f"⚠️ Key {key_index + 1} 發生狀況，嘗試切換...", icon="🔄")
     
-    # 開始輪替嘗試
-    for i in range(total_keys):
-        current_key_index = (st.session_state.current_key_index + i) % total_keys
-        active_key = api_keys[current_key_index]
-        
-        try:
-            # 使用當前的 Key 初始化模型
-            genai.configure(api_key=active_key)
-            
-            # --- 關鍵修改 2：將 System Prompt 綁定為 system_instruction ---
-            model = genai.GenerativeModel(
-                model_name=st.session_state.valid_model_name,
-                system_instruction=system_prompt, # <--- 鎖定學生角色的絕對防線！
-                safety_settings={
-                    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                }
-            )
-            
-            # 使用純淨的歷史紀錄建立 session
-            chat_session = model.start_chat(history=gemini_history)
-            response = chat_session.send_message(text)
-            
-            # 如果成功，記錄最後成功的 Key index，並回傳
-            st.session_state.current_key_index = current_key_index
-            return response.text
-            
-        except Exception as e:
-            error_msg = str(e).lower()
-            st.toast(f"⚠️ Key {current_key_index + 1} 發生狀況，嘗試切換...", icon="🔄")
-            
-            # 如果是最後一把 Key 也失敗了
-            if i == total_keys - 1:
-                if "429" in error_msg or "quota" in error_msg:
-                    st.warning("🐌 哎呀！您輸入的速度太快，或是目前所有 API 額度都耗盡了。請稍等 1 分鐘後再試喔！")
-                    return None
-                else:
-                    raise e
-            # 如果不是最後一把，繼續迴圈嘗試下一把
+    # 如果成功，記錄最後成功的 Key index
+    st.session_state.current_key_index = sim.key_index
+    idle_sessions.get_pool().touch(st.session_state.session_id)
+    checkpoint()
+    return reply
 
 # 初始化 Session State
-if "history" not in st.session_state: st.session_state.history = []
-if "loaded_text" not in st.session_state: st.session_state.loaded_text = ""
 if "user_nickname" not in st.session_state: st.session_state.user_nickname = ""
 if "current_persona" not in st.session_state: st.session_state.current_persona = {}
+if "variant" not in st.session_state: st.session_state.variant = None # A/B 分流，登入時決定
+if "session_id" not in st.session_state: st.session_state.session_id = "" # 演練池與共用狀態後端的編號 (網址的 ?sid=)
 if "start_time" not in st.session_state: st.session_state.start_time = datetime.now()
 if "chat_session_initialized" not in st.session_state: st.session_state.chat_session_initialized = False
+if "export_cache" not in st.session_state: st.session_state.export_cache = None # (對話長度, JSONL bytes, CSV bytes)
+if "cloud_matches" not in st.session_state: st.session_state.cloud_matches = None # 雲端續談的查詢結果 (按下查詢才更新)
 
 # 多重 API Key 記憶機制
 if "raw_api_key_input" not in st.session_state: st.session_state.raw_api_key_input = ""
 if "api_keys_list" not in st.session_state: st.session_state.api_keys_list = []
 if "current_key_index" not in st.session_state: st.session_state.current_key_index = 0
+if "use_response_cache" not in st.session_state: st.session_state.use_response_cache = False
+if "use_hedging" not in st.session_state: st.session_state.use_hedging = False
+if "use_model_fallback" not in st.session_state: st.session_state.use_model_fallback = True
 if "valid_model_name" not in st.session_state: st.session_state.valid_model_name = "gemini-2.5-flash" # 修正預設模型為 2.5-flash
 
+# 重新連線 (或被分到另一個副本) 時，從共用的狀態後端接回原本的演練
+if not st.session_state.user_nickname and st.query_params.get("sid") and session_store.get_store():
+    restored = session_store.get_store().load(st.query_params["sid"])
+    if restored:
+        restore_checkpoint(st.query_params["sid"], restored)
+
 # --- 2. 登入區 ---
 if not st.session_state.user_nickname:
     st.title("🛡️ 歡迎來到創傷知情模擬器")
@@ -179,7 +184,12 @@ if not st.session_state.user_nickname:
     if st.button("🚀 進入系統"):
         if nickname_input.strip():
             st.session_state.user_nickname = nickname_input
+            st.session_state.variant = cohorts.resolve(requested_variant, nickname_input.strip())
             st.session_state.start_time = datetime.now()
+            st.session_state.session_id = session_store.new_session_id()
+            if session_store.get_store():
+                st.query_params["sid"] = st.session_state.session_id
+                checkpoint()
             st.rerun()
         else:
             st.error("❌ 編號不能為空！")
@@ -188,16 +198,27 @@ if not st.session_state.user_nickname:
 # --- 3. 側邊欄設定 ---
 st.sidebar.title(f"👤 學員: {st.session_state.user_nickname}")
 st.sidebar.markdown("*(系統已開啟自動存檔功能)*")
+st.sidebar.caption(f"🧪 分流：{st.session_state.variant}")
 st.sidebar.markdown("---")
 
+def end_session():
+    idle_sessions.get_pool().pop(st.session_state.session_id)
+    st.session_state.current_persona = {}
+    st.session_state.chat_session_initialized = False
+    st.session_state.export_cache = None
+
+# 演練池與磁碟上都找不到 (例如閒置超過保存期限) 時，回到首頁重新開始
+if st.session_state.chat_session_initialized and current_sim() is None:
+    end_session()
+    st.warning("⌛ 這場演練閒置太久已經結束，請重新生成個案或載入紀錄續談。")
+
 # 返回首頁按鈕
 if st.session_state.chat_session_initialized:
     st.sidebar.markdown("### 🏠 導覽")
     if st.sidebar.button("返回首頁 / 換個個案", type="secondary"):
-        st.session_state.history = []
-        st.session_state.current_persona = {}
-        st.session_state.chat_session_initialized = False
+        end_session()
         st.session_state.start_time = datetime.now() 
+        checkpoint()
         st.rerun()
 
 st.sidebar.markdown("---")
@@ -209,7 +230,7 @@ input_key = st.sidebar.text_input("在此貼上您的 API Key", type="password",
 if input_key:
     st.session_state.raw_api_key_input = input_key
     # 將逗號分隔的字串轉為 List，並清除空白
-    st.session_state.api_keys_list = [k.strip() for k in input_key.split(",") if k.strip()]
+    st.session_state.api_keys_list = chat_engine.parse_api_keys(input_key)
 
 if not st.session_state.api_keys_list:
     st.info("💡 提示：請先在側邊欄輸入至少一組 API Key，否則系統無法運作。")
@@ -218,8 +239,7 @@ if not st.session_state.api_keys_list:
 # 模型偵測 (用第一把 Key 測試即可)
 if st.session_state.api_keys_list:
     try:
-        genai.configure(api_key=st.session_state.api_keys_list[0])
-        available_models = [m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
+        available_models = chat_engine.list_models(st.session_state.api_keys_list[0])
         if available_models:
             # 動態抓取 2.5-flash 作為預設選單值
             default_idx = available_models.index("models/gemini-2.5-flash") if "models/gemini-2.5-flash" in available_models else 0
@@ -227,51 +247,76 @@ if st.session_state.api_keys_list:
     except: 
         st.sidebar.error("❌ 第一把 API Key 無效，請檢查。")
 
-student_grade = st.sidebar.selectbox("學生年級 (新個案適用)", ["國小", "國中", "高中"])
-lang = st.sidebar.selectbox("語言", ["繁體中文", "粵語", "English"])
+student_grade = st.sidebar.selectbox("學生年級 (新個案適用)", personas.GRADES)
+lang = st.sidebar.selectbox("語言", personas.LANGUAGES)
 
 # 顯示目前使用的 Key 狀態 (除錯或安心用)
 st.sidebar.caption(f"🛡️ 目前備妥 {len(st.session_state.api_keys_list)} 把 API Key 輪替中")
+breaker_states = chat_engine.breakers.snapshot()
+paused_keys = [i + 1 for i, k in enumerate(st.session_state.api_keys_list) if breaker_states.get(k) == "open"]
+if paused_keys:
+    st.sidebar.caption(f"🔧 Key {', '.join(map(str, paused_keys))} 連續發生狀況，暫停使用中")
+# 額度冷卻由所有程序共用 (其他分流或伺服器撞到 429 的 Key 這裡也會先避開)
+key_usage = key_registry.get_registry()
+cooling_keys = [i + 1 for i, k in enumerate(st.session_state.api_keys_list) if key_usage.cooldown_left(k) > 0]
+if cooling_keys:
+    st.sidebar.caption(f"🧊 Key {', '.join(map(str, cooling_keys))} 額度用完，冷卻中")
 
-# --- 4. 自動讀取教材 ---
-if not st.session_state.loaded_text:
-    combined_text = ""
-    pdf_files = glob.glob("*.pdf")
-    if pdf_files:
-        with st.spinner(f"📚 系統正在內化 {len(pdf_files)} 份教材..."):
-            try:
-                for filename in pdf_files:
-                    reader = PdfReader(filename)
-                    for page in reader.pages:
-                        text = page.extract_text()
-                        if text: combined_text += text + "\n"
-                st.session_state.loaded_text = combined_text
-            except Exception as e:
-                st.error(f"❌ 教材讀取失敗: {e}")
-    else:
-        st.warning("⚠️ 倉庫中找不到 PDF 檔案。")
-
-# --- 5. 隨機劇本生成器 (基礎資料) ---
-def generate_random_persona(grade):
-    names = ["小明", "小華", "安安", "凱凱", "婷婷", "阿宏"]
-    backgrounds = ["長期被忽視", "目睹家暴", "照顧者情緒不穩", "曾受肢體暴力"]
-    triggers = ["被當眾糾正", "感覺不公平", "環境吵雜", "被誤會"]
-    responses = ["戰 (Fight) - 頂嘴/憤怒", "逃 (Flight) - 逃避", "凍結 (Freeze) - 呆滯", "討好 (Fawn) - 過度道歉"]
-    return {
-        "name": random.choice(names),
-        "background": random.choice(backgrounds),
-        "trigger": random.choice(triggers),
-        "response_mode": random.choice(responses),
-        "grade": grade
-    }
+# 備援加速：有多把 Key 時，太慢的請求改用另一把 Key 同時再送一次，先回來的先用
+if len(st.session_state.api_keys_list) > 1:
+    st.session_state.use_hedging = st.sidebar.toggle(
+        "⚡ 備援加速", value=st.session_state.use_hedging,
+        help="回應超過近期 90% 的等待時間時，自動用另一把 Key 再送一次。最多約 10% 的訊息會多耗一次額度。"
+    )
+else:
+    st.session_state.use_hedging = False
+
+# 模型自動降級：選用的模型太慢或額度吃緊時，新訊息暫時改用備援模型，之後自動恢復
+st.session_state.use_model_fallback = st.sidebar.toggle(
+    "🔀 自動降級模型", value=st.session_state.use_model_fallback,
+    help=f"目前模型太慢或額度吃緊時，新訊息會依序改用：{' → '.join(model_policy.DEFAULT_FALLBACK_CHAIN)}。每則回應使用的模型都會記錄在存檔中。"
+)
+if st.session_state.use_model_fallback:
+    for degraded_model, info in model_policy.policy.status().items():
+        st.sidebar.caption(f"🔀 {degraded_model} 暫時降級 ({info['reason']})，約 {info['seconds_left']} 秒後恢復")
+
+# 重播模式 (講師示範 / 回歸測試用)：相同輸入直接使用快取的回應
+st.session_state.use_response_cache = st.sidebar.toggle(
+    "🎬 重播模式 (回應快取)", value=st.session_state.use_response_cache,
+    help="同一個個案、同樣的老師輸入會直接重播上次的學生回應，不耗用 API 額度。正式研究演練請關閉。"
+)
+if st.session_state.use_response_cache:
+    stats = response_cache.get_shared_cache().stats()
+    st.sidebar.caption(f"🎬 快取命中 {stats['hits']} 次 / 未命中 {stats['misses']} 次 (命中率 {stats['hit_rate']:.0%})")
+
+# --- 4. 自動讀取教材 (整個程序只讀一次，所有學員與分流共用) ---
+# 教材在背景逐份讀取：讀到的字數夠放進 Prompt 就可以開始演練，剩下的繼續在背景讀
+corpus_loader = corpus.get_shared_loader()
+knowledge = ""
+if corpus_loader.files:
+    if corpus_loader.chars < personas.KNOWLEDGE_CHAR_LIMIT and not corpus_loader.done:
+        with st.spinner(f"📚 系統正在內化 {len(corpus_loader.files)} 份教材..."):
+            corpus_loader.wait(personas.KNOWLEDGE_CHAR_LIMIT)
+    knowledge = corpus_loader.text()
+    if corpus_loader.error is not None and not knowledge:
+        st.error(f"❌ 教材讀取失敗: {corpus_loader.error}")
+    elif not corpus_loader.done:
+        st.sidebar.caption(f"📚 教材背景讀取中 ({corpus_loader.loaded_files}/{len(corpus_loader.files)} 份)")
+else:
+    st.warning("⚠️ 倉庫中找不到 PDF 檔案。")
+
+# --- 5. 隨機劇本生成器 ---
+# 基礎資料、隨機生成與角色設定 Prompt 都在 personas.py (離線開場白快取也共用同一份)
 
 # --- 6. 模擬器主畫面 ---
 st.title("🛡️ 創傷知情模擬器")
 
-if st.session_state.loaded_text and st.session_state.api_keys_list and st.session_state.valid_model_name:
+if knowledge and st.session_state.api_keys_list and st.session_state.valid_model_name:
 
     if not st.session_state.chat_session_initialized:
-        tab1, tab2 = st.tabs(["🎲 隨機生成新個案", "📂 載入舊紀錄續談"])
+        # 進到個案設定頁時先在背景把每把 Key 的連線建好，第一則回應不必再等連線 (已經建好的不會重做)
+        engine.submit(chat_engine.clients.warm_up(st.session_state.api_keys_list, st.session_state.valid_model_name))
+        tab1, tab2, tab3 = st.tabs(["🎲 隨機生成新個案", "📂 載入舊紀錄續談", "☁️ 從雲端紀錄續談"])
         
         # [模式一] 隨機新個案 
         with tab1:
@@ -279,153 +324,170 @@ if st.session_state.loaded_text and st.session_state.api_keys_list and st.sessio
             with st.expander("⚙️ 進階設定：自訂晤談情境 (非必填)", expanded=False):
                 col1, col2 = st.columns(2)
                 with col1:
-                    session_num = st.slider("這是第幾次晤談？", 1, 10, 1)
+                    session_num = st.slider("這是第幾次晤談？", 1, 10, personas.DEFAULT_SESSION_NUM)
                 with col2:
-                    rel_status = st.selectbox("目前的信任關係", ["初次見面 / 不熟", "建立信任中", "關係良好 / 依賴", "關係破裂 / 敵對", "冷淡 / 防衛"], index=0)
-                recent_event = st.text_input("近期發生事件 / 前情提要", value="無特殊事件，日常互動。")
+                    rel_status = st.selectbox("目前的信任關係", personas.RELATIONS, index=0)
+                recent_event = st.text_input("近期發生事件 / 前情提要", value=personas.DEFAULT_RECENT_EVENT)
 
             if st.button("🎲 生成案例並開始", type="primary"):
-                persona = generate_random_persona(student_grade)
-                persona['session_num'] = session_num
-                persona['relation'] = rel_status
-                persona['recent_event'] = recent_event
-                st.session_state.current_persona = persona
-                
-                # 【加入括號表情指示的強化版 Prompt】
-                sys_prompt = f"""
-                Role: You are a {persona['grade']} student named {persona['name']}. 
-                
-                [CORE PROFILE]
-                Trauma Background: {persona['background']}. 
-                Current Trigger: {persona['trigger']}.
-                Dominant Response Mode: {persona['response_mode']}.
-                
-                [SCENARIO CONTEXT]
-                - Session Number: This is the {session_num} time you are talking to this teacher.
-                - Relationship Quality: {rel_status}.
-                - Recent Life Event: {recent_event}.
-                
-                [KNOWLEDGE BASE]
-                {st.session_state.loaded_text[:25000]}
+                start_session(engine.ConversationSession.new_case(
+                    st.session_state.user_nickname, knowledge, student_grade, lang,
+                    session_num=session_num, relation=rel_status, recent_event=recent_event,
+                    variant=st.session_state.variant,
+                ))
                 
-                [INSTRUCTIONS]
-                1. Act strictly according to the 'Scenario Context'. 
-                   - If session > 1, do NOT introduce yourself like a stranger.
-                   - If relationship is bad, be guarded or hostile.
-                   - If relationship is good, show some trust but still react to the trigger.
-                2. Respond naturally based on your response mode ({persona['response_mode']}).
-                3. Language: {lang}.
-                4. Stay in character. Do not explain you are an AI.
-                5. Actions and Expressions: The user may use parentheses ( ) to describe their non-verbal behaviors. YOU MUST also use parentheses ( ) to describe the student's body language, facial expressions, or emotional state in your responses.
-                """
-                
-                # 初始化對話歷史
-                st.session_state.history = [{"role": "user", "content": sys_prompt}]
-                st.session_state.chat_session_initialized = True
-                
-                # 使用輪替機制發送第一句
-                resp_text = send_message_safely("Action: Start interaction based on context.")
-                if resp_text:
-                    st.session_state.history.append({"role": "assistant", "content": resp_text})
-                    auto_save_to_google_sheets(st.session_state.user_nickname, st.session_state.history)
+                # 學生先開口 (預設晤談情境會直接用離線預先產生的開場白)
+                if send_message_safely():
+                    current_sim().save_in_background()
                 st.rerun()
         
         # [模式二] 載入舊檔
         with tab2:
             st.markdown("### 延續之前的演練")
-            uploaded_file = st.file_uploader("請上傳上次下載的 .csv 紀錄檔", type=['csv'])
+            uploaded_file = st.file_uploader("請上傳上次下載的 .jsonl 續談檔 (舊版 .csv 紀錄檔也可以)", type=['jsonl', 'csv'])
             
             if uploaded_file is not None:
                 try:
-                    df = pd.read_csv(uploaded_file)
-                    if 'meta_persona' in df.columns:
-                        persona_json = df['meta_persona'].iloc[0]
-                        st.session_state.current_persona = json.loads(persona_json)
-                        p = st.session_state.current_persona
-                        st.success(f"✅ 成功載入個案：{p['name']} (第{p.get('session_num','?')}次晤談)")
-                        
-                        restored_history = []
-                        # 【續談時同樣加入括號表情指示】
-                        sys_prompt = f"""
-                        Role: You are a {p['grade']} student named {p['name']}. 
-                        Trauma Background: {p['background']}. 
-                        Trigger: {p['trigger']}.
-                        Response Mode: {p['response_mode']}.
-                        
-                        [CONTEXT RESUMED]
-                        - Session Num: {p.get('session_num', 1)}
-                        - Relationship: {p.get('relation', 'Unknown')}
-                        - Recent Event: {p.get('recent_event', 'Unknown')}
-                        
-                        Knowledge Base: {st.session_state.loaded_text[:25000]}
-                        
-                        Instruction: Continue the conversation naturally. Language: {lang}. 
-                        Remember: YOU MUST use parentheses ( ) to describe the student's body language, facial expressions, or emotional state in your responses.
-                        """
-                        restored_history.append({"role":"user", "content": sys_prompt})
-                        
-                        # 略過原本的第一句 prompt，只載入純對話內容
-                        for index, row in df.iterrows():
-                            if "Role: You are a" not in str(row['content']):
-                                restored_history.append({"role": row['role'], "content": row['content']})
-                        
-                        st.session_state.history = restored_history
-                        st.session_state.chat_session_initialized = True
-                        
-                        if st.button("🚀 繼續對話"):
-                            st.session_state.start_time = datetime.now()
-                            st.rerun()
-                    else:
-                        st.error("❌ 這個 CSV 檔案不包含個案設定資料，無法用於續談。")
+                    persona, turns = session_io.load_session(uploaded_file.getvalue(), uploaded_file.name)
+                    st.success(f"✅ 成功載入個案：{persona['name']} (第{persona.get('session_num','?')}次晤談)")
+                    
+                    # 續談檔已略過原本的第一句 prompt，只有純對話內容
+                    start_session(engine.ConversationSession.resume(
+                        st.session_state.user_nickname, persona, turns, knowledge, lang,
+                        variant=st.session_state.variant))
+                    
+                    if st.button("🚀 繼續對話"):
+                        st.session_state.start_time = datetime.now()
+                        st.rerun()
+                except ValueError as e:
+                    st.error(f"❌ {e}")
                 except Exception as e:
                     st.error(f"❌ 檔案讀取失敗: {e}")
 
+        # [模式三] 從研究資料庫直接續談 (不必下載再上傳檔案)
+        with tab3:
+            st.markdown("### 從雲端紀錄續談")
+            if not research_sheet_configured():
+                st.info("☁️ 這個部署沒有連接研究資料庫，請改用「上傳續談檔」。")
+            else:
+                # 按下查詢才讀雲端 (每次重跑都查會很快用完 Google Sheets 的讀取額度)；只能查自己的紀錄
+                with st.form("cloud_lookup"):
+                    lookup_id = st.text_input("學員編號或紀錄編號 (Session ID)", value=st.session_state.user_nickname,
+                                              help="紀錄編號格式為「學員編號_登入時間」，只輸入學員編號會列出您所有的紀錄。"
+                                                   "只能查詢目前登入的學員編號的紀錄。")
+                    if st.form_submit_button("🔍 查詢") and lookup_id.strip():
+                        try:
+                            st.session_state.cloud_matches = sheets_store.find_sessions(
+                                get_research_worksheet(), lookup_id, user_id=st.session_state.user_nickname)
+                        except Exception as e:
+                            st.session_state.cloud_matches = None
+                            st.error(f"❌ 雲端紀錄讀取失敗: {e}")
+                matches = st.session_state.cloud_matches
+                if matches == []:
+                    st.info("🔍 找不到這個編號的紀錄 (只能查詢自己的紀錄)。")
+                elif matches:
+                    choice = st.selectbox("選擇要續談的紀錄", matches, format_func=lambda m: f"{m[1]} ({m[0]})")
+                    if st.button("☁️ 載入並繼續對話"):
+                        try:
+                            persona, turns = sheets_store.fetch_session(get_research_worksheet(), choice[2])
+                            start_session(engine.ConversationSession.resume(
+                                st.session_state.user_nickname, persona, turns, knowledge, lang,
+                                variant=st.session_state.variant))
+                            st.session_state.start_time = datetime.now()
+                            st.session_state.cloud_matches = None
+                            st.rerun()
+                        except ValueError as e:
+                            st.error(f"❌ {e}")
+                        except Exception as e:
+                            st.error(f"❌ 雲端紀錄讀取失敗: {e}")
+
     # C. 顯示對話
-    if st.session_state.chat_session_initialized:
-        p = st.session_state.current_persona
-        st.info(f"🎭 **演練中**：{p.get('grade')}生 **{p.get('name')}** | 第 {p.get('session_num',1)} 次晤談 | 關係：{p.get('relation','未知')} | 前情：{p.get('recent_event','無')}")
-        
-        for msg in st.session_state.history:
-            role = "assistant" if msg["role"] == "assistant" else "user"
-            # 隱藏系統 Prompt，不讓使用者看到落落長的設定
-            if "Role: You are a" not in msg["content"]:
-                with st.chat_message(role):
-                    st.write(msg["content"])
+    @st.fragment
+    def chat_pane():
+        """
+        對話區獨立成 fragment：老師送出訊息時只重跑這一區，
+        不會重跑側邊欄、模型偵測與教材檢查；新的回覆直接接在下方，不再整頁 st.rerun()。
+        """
+        # 角色設定 Prompt 另外存放，不會出現在對話中
+        for turn in current_sim().conversation:
+            role = "assistant" if turn.role == "assistant" else "user"
+            with st.chat_message(role):
+                st.write(turn.content)
 
         if user_in := st.chat_input("老師回應... (可用括號描述動作，例如：(微笑點頭) 發生什麼事了？)"):
-            st.session_state.history.append({"role": "user", "content": user_in})
             with st.chat_message("user"):
                 st.write(user_in)
                 
             with st.spinner("⏳ 學生正在思考如何回應 (為防超速，請稍候)..."):
                 try:
                     # 使用自動輪替機制的安全發送函式
-                    resp_text = send_message_safely(user_in)
+                    reply = send_message_safely(user_in)
                     
-                    if resp_text: 
-                        st.session_state.history.append({"role": "assistant", "content": resp_text})
-                        auto_save_to_google_sheets(st.session_state.user_nickname, st.session_state.history)
-                        st.rerun()
+                    if reply: 
+                        with st.chat_message("assistant"):
+                            st.write(reply["content"])
+                        current_sim().save_in_background()
+                        # 側邊欄已備好的下載檔不含這一輪：作廢後整頁重跑，避免學員下載到缺了最新對話的續談檔
+                        if st.session_state.export_cache is not None:
+                            st.session_state.export_cache = None
+                            st.rerun(scope="app")
                 except Exception as e:
                     st.error(f"❌ 發生嚴重錯誤: {e}")
 
+    if st.session_state.chat_session_initialized:
+        p = st.session_state.current_persona
+        st.info(f"🎭 **演練中**：{p.get('grade')}生 **{p.get('name')}** | 第 {p.get('session_num',1)} 次晤談 | 關係：{p.get('relation','未知')} | 前情：{p.get('recent_event','無')}")
+        
+        chat_pane()
+
 # --- 7. 下載功能區 ---
-st.sidebar.markdown("---")
-if st.session_state.history:
-    st.sidebar.subheader("💾 紀錄保存")
-    df = pd.DataFrame(st.session_state.history)
+def build_export_csv():
+    """把目前的對話紀錄轉成 CSV bytes (只在學員按下「準備下載檔」時才執行)"""
+    import pandas as pd
+    # 沿用舊版紀錄檔格式：第一列是角色設定 Prompt
+    df = pd.DataFrame(current_sim().conversation.to_history())
     df['nickname'] = st.session_state.user_nickname
     df['time'] = (datetime.now() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
     
     persona_json = json.dumps(st.session_state.current_persona, ensure_ascii=False)
     df['meta_persona'] = persona_json
     
-    csv = df.to_csv(index=False).encode('utf-8-sig')
-    
-    st.sidebar.download_button(
-        label="📥 下載對話紀錄 (含續談資料)",
-        data=csv,
-        file_name=f"模擬器_{st.session_state.user_nickname}_{st.session_state.current_persona.get('name')}.csv",
-        mime="text/csv",
-        help="下載此檔案可保留目前的對話進度與情境設定。"
+    return df.to_csv(index=False).encode('utf-8-sig')
+
+def build_export_jsonl():
+    """續談檔 (JSONL)：標頭記錄個案設定，之後每行一則對話"""
+    return session_io.dump_session_jsonl(
+        current_sim().conversation.to_dicts(),
+        st.session_state.current_persona,
+        nickname=st.session_state.user_nickname,
+        saved_at=(datetime.now() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S"),
     )
+
+def prepare_export():
+    # 以對話長度當快取鍵：對話沒有新增時，重複下載不必再序列化一次
+    st.session_state.export_cache = (len(current_sim().conversation), build_export_jsonl(), build_export_csv())
+
+st.sidebar.markdown("---")
+history = current_sim().conversation if st.session_state.chat_session_initialized else []
+if history:
+    st.sidebar.subheader("💾 紀錄保存")
+    cached = st.session_state.export_cache
+    
+    if cached and cached[0] == len(history):
+        file_stem = f"模擬器_{st.session_state.user_nickname}_{st.session_state.current_persona.get('name')}"
+        st.sidebar.download_button(
+            label="📥 下載續談檔 (.jsonl)",
+            data=cached[1],
+            file_name=f"{file_stem}.jsonl",
+            mime="application/jsonl",
+            help="下載此檔案可保留目前的對話進度與情境設定，下次上傳即可續談。"
+        )
+        st.sidebar.download_button(
+            label="📥 下載對話紀錄 (.csv)",
+            data=cached[2],
+            file_name=f"{file_stem}.csv",
+            mime="text/csv",
+            help="可用 Excel 開啟的完整紀錄，同樣可用於續談。"
+        )
+    else:
+        st.sidebar.button("📦 準備下載檔", on_click=prepare_export, help="整理目前的對話紀錄，整理完成後即可下載。")
@@ -0,0 +1,194 @@
+"""
+模型比較工具：拿已經存下來的演練紀錄，把老師的每一則訊息依序重送給幾個候選模型，
+比較延遲 (p50/p90/p99)、吞吐量、token 用量與回應長度，工作坊要用哪個模型改以實測數據決定。
+
+    GEMINI_API_KEYS=key1,key2 python bench_models.py 紀錄1.csv 紀錄2.jsonl \\
+        --models gemini-2.5-flash gemini-2.5-flash-lite gemini-2.0-flash --concurrency 4
+    GCP_SERVICE_ACCOUNT=service_account.json python bench_models.py --records 001 002 --models ...
+
+紀錄可以是下載的 .csv / .jsonl 續談檔，或研究資料庫中的紀錄 (--records 給學員編號或紀錄編號)。
+每一則老師訊息都以「紀錄中在它之前的對話」當歷史重送 (不接模型自己的回答)，各模型的題目完全相同。
+角色設定 Prompt 依個案設定與目前的教材重新組出 (與線上開新個案相同)。
+同時進行的請求數以 --concurrency 限制，Key 依序輪流使用；失敗不重試，直接計入錯誤。
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+
+import chat_engine
+import key_registry
+import personas
+import session_io
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def load_transcripts(paths=(), record_ids=(), creds_path=None):
+    """讀取演練紀錄，回傳 [(來源, persona, turns), ...]；讀不了的紀錄印出原因後略過"""
+    transcripts = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                persona, turns = session_io.load_session(f.read(), path)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 略過 {path}：{e}", file=sys.stderr)
+            continue
+        transcripts.append((path, persona, turns))
+    if record_ids:
+        import sheets_store
+
+        with open(creds_path, encoding="utf-8") as f:
+            worksheet = sheets_store.connect(json.load(f))
+        for record_id in record_ids:
+            matches = sheets_store.find_sessions(worksheet, record_id)
+            if not matches:
+                print(f"⚠️ 找不到紀錄 {record_id}", file=sys.stderr)
+            for session_id, _, row in matches:
+                try:
+                    persona, turns = sheets_store.fetch_session(worksheet, row)
+                except ValueError as e:
+                    print(f"⚠️ 略過 {session_id}：{e}", file=sys.stderr)
+                    continue
+                transcripts.append((session_id, persona, turns))
+    return transcripts
+
+
+def build_jobs(transcripts, knowledge, lang, max_turns=None):
+    """每一則老師訊息一題：(來源, 第幾則, 角色設定 Prompt, 之前的對話 (Gemini 格式), 老師訊息)"""
+    import knowledge_slices
+
+    jobs = []
+    for source, persona, turns in transcripts:
+        system_prompt = personas.build_system_prompt(persona, knowledge_slices.knowledge_for(persona, knowledge), lang)
+        teacher_turns = [i for i, msg in enumerate(turns) if msg["role"] == "user"][:max_turns]
+        for i in teacher_turns:
+            jobs.append((source, i, system_prompt, chat_engine.to_gemini_history(turns[:i]), turns[i]["content"]))
+    return jobs
+
+
+async def run_benchmark(jobs, models, api_keys, concurrency=4, timeout=chat_engine.ATTEMPT_TIMEOUT):
+    """所有 (模型, 題目) 交錯送出，同時最多 concurrency 個請求；回傳每一次請求的結果"""
+    semaphore = asyncio.Semaphore(concurrency)
+    key_cycle = itertools.cycle(range(len(api_keys)))
+    registry = key_registry.get_registry()
+
+    async def one(model_name, job):
+        source, turn_index, system_prompt, history, text = job
+        async with semaphore:
+            api_key = api_keys[next(key_cycle)]
+            registry.record(api_key)
+            result = {"model": model_name, "source": source, "turn": turn_index, "started": time.perf_counter()}
+            try:
+                response = await chat_engine.generate_async(api_key, model_name, system_prompt, history, text,
+                                                            timeout=timeout)
+                usage = getattr(response, "usage_metadata", None)
+                result.update(
+                    ok=True,
+                    prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+                    output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+                    output_chars=len(response.text),
+                )
+            except Exception as e:
+                result.update(ok=False, error=f"{type(e).__name__}: {e}"[:200],
+                              quota=chat_engine.is_quota_error(e))
+            result["finished"] = time.perf_counter()
+            result["seconds"] = result["finished"] - result["started"]
+            return result
+
+    # 模型交錯排列，每個模型都分散在整段時間中，不會因為排在後面而吃到不同的尖峰
+    tasks = [one(model_name, job) for job in jobs for model_name in models]
+    return await asyncio.gather(*tasks)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(results, models):
+    summary = []
+    for model_name in models:
+        rows = [r for r in results if r["model"] == model_name]
+        ok = [r for r in rows if r["ok"]]
+        entry = {"model": model_name, "requests": len(rows), "ok": len(ok),
+                 "quota_errors": sum(1 for r in rows if not r["ok"] and r.get("quota"))}
+        if ok:
+            seconds = [r["seconds"] for r in ok]
+            wall = max(r["finished"] for r in rows) - min(r["started"] for r in rows)
+            entry.update({f"p{round(q * 100)}": _percentile(seconds, q) for q in PERCENTILES})
+            entry.update(
+                throughput=len(ok) / wall if wall else 0.0,
+                prompt_tokens=statistics.mean(r["prompt_tokens"] for r in ok),
+                output_tokens=statistics.mean(r["output_tokens"] for r in ok),
+                output_chars=statistics.mean(r["output_chars"] for r in ok),
+            )
+        summary.append(entry)
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'模型':<32}{'成功/總數':>10}{'p50':>8}{'p90':>8}{'p99':>8}{'次/秒':>8}"
+          f"{'輸入 token':>12}{'輸出 token':>12}{'回應字數':>10}")
+    for s in summary:
+        if not s["ok"]:
+            print(f"{s['model'][:32]:<32}{s['ok']:>5}/{s['requests']:<4}   全部失敗 (額度錯誤 {s['quota_errors']} 次)")
+            continue
+        print(f"{s['model'][:32]:<32}{s['ok']:>5}/{s['requests']:<4}{s['p50']:>8.2f}{s['p90']:>8.2f}{s['p99']:>8.2f}"
+              f"{s['throughput']:>8.2f}{s['prompt_tokens']:>12.0f}{s['output_tokens']:>12.0f}{s['output_chars']:>10.0f}")
+
+
+def write_results(results, path):
+    fields = ["model", "source", "turn", "ok", "seconds", "prompt_tokens", "output_tokens", "output_chars", "error"]
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以存下來的演練紀錄比較各模型的延遲、吞吐量與 token 用量")
+    parser.add_argument("files", nargs="*", help="續談檔 (.jsonl) 或下載的紀錄 (.csv)")
+    parser.add_argument("--records", nargs="*", default=[], help="研究資料庫中的學員編號或紀錄編號 (需要 GCP_SERVICE_ACCOUNT)")
+    parser.add_argument("--models", nargs="+", required=True, help="要比較的模型")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時進行的請求數")
+    parser.add_argument("--max-turns", type=int, default=None, help="每份紀錄最多重送幾則老師訊息")
+    parser.add_argument("--lang", default=personas.LANGUAGES[0], choices=personas.LANGUAGES)
+    parser.add_argument("--timeout", type=float, default=chat_engine.ATTEMPT_TIMEOUT, help="單一請求的逾時 (秒)")
+    parser.add_argument("--out", default=None, help="把每一次請求的結果存成 CSV")
+    parser.add_argument("--pdf-glob", default="*.pdf", help="教材 PDF 的路徑樣式")
+    args = parser.parse_args(argv)
+
+    api_keys = chat_engine.env_api_keys()
+    if not api_keys:
+        return 1
+    if args.records and not os.environ.get("GCP_SERVICE_ACCOUNT"):
+        print("❌ 從研究資料庫讀取紀錄需要以環境變數 GCP_SERVICE_ACCOUNT 指定服務帳戶憑證檔", file=sys.stderr)
+        return 1
+
+    transcripts = load_transcripts(args.files, args.records, os.environ.get("GCP_SERVICE_ACCOUNT"))
+    import corpus
+    jobs = build_jobs(transcripts, corpus.load_corpus_text(corpus.find_pdf_files(args.pdf_glob)), args.lang,
+                      args.max_turns)
+    if not jobs:
+        print("❌ 紀錄中沒有任何老師訊息可以重送", file=sys.stderr)
+        return 1
+
+    print(f"🏁 {len(transcripts)} 份紀錄、{len(jobs)} 則老師訊息 × {len(args.models)} 個模型，同時 {args.concurrency} 個請求")
+    t0 = time.perf_counter()
+    results = asyncio.run(run_benchmark(jobs, args.models, api_keys, args.concurrency, args.timeout))
+    print(f"⏱️ 共 {time.perf_counter() - t0:.1f} 秒\n")
+    print_summary(summarize(results, args.models))
+    if args.out:
+        write_results(results, args.out)
+        print(f"\n💾 每次請求的結果已存成 {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
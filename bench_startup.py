@@ -0,0 +1,128 @@
+"""
+冷啟動量測工具：記錄每個套件的載入時間，確認登入畫面的載入預算。
+
+用法：
+    python bench_startup.py                 # 逐一量測各套件冷啟動載入時間
+    python bench_startup.py --repeat 5      # 每個套件量 5 次取中位數
+    python bench_startup.py --budget-ms 800 # 登入畫面所需套件超過預算時回傳非 0
+    python bench_startup.py --app app.py    # 額外量測登入畫面第一次渲染 (需安裝 streamlit)
+
+每次量測都在全新的子程序中進行，避免 sys.modules 快取讓數字失真。
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# 登入畫面真正需要的套件 (app.py 最上方的 import)
+LOGIN_MODULES = [
+    "streamlit", "os", "json", "datetime",
+    "admission", "chat_engine", "cohorts", "conversation", "corpus", "engine", "idle_sessions", "key_registry",
+    "knowledge_slices", "model_policy", "opening_cache", "personas", "response_cache", "session_io", "session_store",
+    "sheets_store",
+]
+
+# 改為延遲載入的大型套件：第一次用到時才 import
+LAZY_MODULES = [
+    "pandas",                                # 續談 CSV / 下載紀錄
+    "pypdf",                                 # 教材讀取
+    "google.generativeai",                   # 對話引擎
+    "gspread",                               # 自動存檔
+    "oauth2client.service_account",          # 自動存檔 (憑證)
+]
+
+_IMPORT_SNIPPET = """
+import time, sys
+t0 = time.perf_counter()
+import {mod}
+print(time.perf_counter() - t0)
+"""
+
+_APP_SNIPPET = """
+import sys, time, json
+from streamlit.testing.v1 import AppTest
+t0 = time.perf_counter()
+at = AppTest.from_file({path!r}, default_timeout=60)
+at.run()
+elapsed = time.perf_counter() - t0
+loaded = [m for m in {lazy!r} if m in sys.modules]
+print(json.dumps({{"seconds": elapsed, "loaded": loaded}}))
+"""
+
+
+def measure_import(mod, repeat=3):
+    """在乾淨的子程序中 import 指定套件，回傳各次秒數；套件不存在時回傳 None"""
+    samples = []
+    for _ in range(repeat):
+        proc = subprocess.run(
+            [sys.executable, "-c", _IMPORT_SNIPPET.format(mod=mod)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            return None
+        samples.append(float(proc.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def measure_app(path):
+    """用 streamlit 的 AppTest 跑一次腳本 (未登入狀態)，量測登入畫面的首次渲染時間"""
+    proc = subprocess.run(
+        [sys.executable, "-c", _APP_SNIPPET.format(path=path, lazy=LAZY_MODULES)],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        return None
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="量測模擬器各套件的冷啟動載入時間")
+    parser.add_argument("--repeat", type=int, default=3, help="每個套件量測次數 (取中位數)")
+    parser.add_argument("--budget-ms", type=float, default=None, help="登入畫面套件的總載入預算 (毫秒)")
+    parser.add_argument("--app", default=None, help="額外量測指定腳本的登入畫面首次渲染")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式輸出結果")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for group, mods in (("login", LOGIN_MODULES), ("lazy", LAZY_MODULES)):
+        for mod in mods:
+            samples = measure_import(mod, args.repeat)
+            results[mod] = {
+                "group": group,
+                "ms": round(statistics.median(samples) * 1000, 1) if samples else None,
+            }
+
+    login_ms = sum(r["ms"] or 0 for r in results.values() if r["group"] == "login")
+    lazy_ms = sum(r["ms"] or 0 for r in results.values() if r["group"] == "lazy")
+    report = {"modules": results, "login_total_ms": round(login_ms, 1), "lazy_total_ms": round(lazy_ms, 1)}
+
+    if args.app:
+        report["app"] = measure_app(args.app)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"{'套件':<32}{'分類':<8}{'載入 (ms)':>10}")
+        for mod, r in results.items():
+            ms = f"{r['ms']:.1f}" if r["ms"] is not None else "未安裝"
+            print(f"{mod:<32}{r['group']:<8}{ms:>10}")
+        print(f"\n登入畫面套件合計：{login_ms:.1f} ms")
+        print(f"延遲載入套件合計：{lazy_ms:.1f} ms (已從首次渲染中移除)")
+        if args.app:
+            app = report["app"]
+            if app is None:
+                print(f"⚠️ 無法量測 {args.app} (請確認已安裝 streamlit)")
+            else:
+                print(f"{args.app} 登入畫面首次渲染：{app['seconds'] * 1000:.1f} ms")
+                if app["loaded"]:
+                    print(f"⚠️ 登入畫面仍載入了：{', '.join(app['loaded'])}")
+
+    if args.budget_ms is not None and login_ms > args.budget_ms:
+        print(f"❌ 超出冷啟動預算 {args.budget_ms:.0f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,596 @@
+"""
+對話引擎：API Key 輪替、逾時與斷路器、備援加速 (hedged request) 與延遲統計。
+
+不依賴 streamlit，以 asyncio 實作 (使用 Gemini 的非同步 client)，一個 event loop 可同時服務許多學員；
+學員層級的 API 在 engine.py，app.py 與各分流版本透過它呼叫。
+錯誤提示等畫面相關的處理由呼叫端以 on_key_error 回呼自行決定。
+
+逾時：每次嘗試最多等 ATTEMPT_TIMEOUT 秒，整輪 (含換 Key 重試) 最多 TURN_DEADLINE 秒，
+學員最壞情況的等待時間因此有上限。
+
+斷路器：每把 Key 連續失敗 BREAKER_FAILURES 次就「斷開」BREAKER_COOLDOWN 秒，期間所有學員都跳過這把 Key；
+冷卻後只放一個請求試探 (half-open)，成功才恢復。整個程序共用，一位學員踩到的壞 Key 其他人不必再踩。
+
+備援加速：同一則訊息若超過「近期 p90 延遲」還沒回來，就用另一把可用的 Key 再送一次，
+哪個先回來用哪個，另一個直接取消。備援次數受 HEDGE_MAX_RATE 限制，避免浪費額度。
+
+模型降級：每次嘗試的延遲與 429 都會回報給 model_policy，傳入 fallback_models 時由它決定這一輪用哪個模型。
+模型本身無法使用 (404 等) 不是 Key 的問題，不計入斷路器；有備援鏈時同一輪直接改用下一個模型。
+
+跨程序用量：每次嘗試與用掉的 token 都登記到 key_registry，撞到 429 的 Key 所有程序一起冷卻；
+冷卻中或這一分鐘已到上限的 Key 跟斷路器斷開的 Key 一樣跳過。
+登記後端是 SQLite / Redis，查詢與寫入都在執行緒池中進行，不佔用事件迴圈 (用量的寫入不等它完成)。
+
+串流 (stream_message)：邊生成邊把文字交給呼叫端；還沒輸出任何文字前失敗才換 Key，不做備援加速。
+
+連線重複使用：每把 Key 一個長期使用的 client (ClientPool)，連線建立後每一輪直接沿用，不必每次重新握手；
+學員進到個案設定頁時先以 warm_up() 把連線建好。全程不用全域的 genai.configure()，不同 Key 同時使用也不會互相覆蓋。
+"""
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+import key_registry
+import model_policy
+
+HEDGE_MAX_RATE = 0.1          # 最多 10% 的請求可以觸發備援
+HEDGE_DEFAULT_DELAY = 8.0     # 延遲樣本不足時，等多久才備援 (秒)
+HEDGE_MIN_SAMPLES = 10        # 至少累積幾筆延遲樣本才採用 p90
+LATENCY_WINDOW = 100          # 每個模型保留幾筆延遲樣本
+HEDGE_RATE_WINDOW = 600       # 計算備援比例的時間視窗 (秒)
+
+ATTEMPT_TIMEOUT = 30.0        # 單次嘗試的逾時 (秒)
+TURN_DEADLINE = 60.0          # 一輪對話 (含所有重試) 的總時限 (秒)
+BREAKER_FAILURES = 3          # 連續失敗幾次就斷開
+BREAKER_COOLDOWN = 30.0       # 斷開後多久才試探 (秒)
+
+CLIENT_POOL_SIZE = 64         # 最多保留幾個 client (每位學員可能各自帶 Key，最久沒用的先釋放)
+WARM_UP_TIMEOUT = 10.0        # 預熱連線的逾時 (秒)
+
+
+def safety_settings():
+    from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+    return {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    }
+
+
+def parse_api_keys(raw):
+    """逗號分隔的 API Key 字串轉成清單 (去掉空白與空項目)"""
+    return [k.strip() for k in raw.split(",") if k.strip()]
+
+
+def env_api_keys():
+    """命令列工具共用：讀取環境變數 GEMINI_API_KEYS；沒有設定時印出提示並回傳空清單"""
+    api_keys = parse_api_keys(os.environ.get("GEMINI_API_KEYS", ""))
+    if not api_keys:
+        print("❌ 請以環境變數 GEMINI_API_KEYS 提供至少一組 API Key (多組用逗號隔開)", file=sys.stderr)
+    return api_keys
+
+
+def to_gemini_turn(role, content):
+    return {"role": "model" if role == "assistant" else "user", "parts": [content]}
+
+
+def to_gemini_history(history):
+    """把 [{"role", "content"}] 轉成 Gemini 的 [{"role": "user"|"model", "parts": [...]}]"""
+    return [to_gemini_turn(msg["role"], msg["content"]) for msg in history]
+
+
+class AttemptTimeout(TimeoutError):
+    """單次嘗試超過 ATTEMPT_TIMEOUT"""
+
+
+class TurnDeadlineExceeded(TimeoutError):
+    """整輪對話超過 TURN_DEADLINE 仍沒有成功"""
+
+
+class NoKeyAvailable(RuntimeError):
+    """所有 Key 的斷路器都處於斷開狀態，或都在額度冷卻中"""
+
+
+def is_quota_error(exc):
+    error_msg = str(exc).lower()
+    return "429" in error_msg or "quota" in error_msg
+
+
+def is_model_error(exc):
+    """模型本身無法使用 (不存在、這個 API 版本不支援)，換哪把 Key 都一樣"""
+    error_msg = str(exc).lower()
+    return "404" in error_msg or "not found" in error_msg or "is not supported" in error_msg
+
+
+def _model_path(model_name):
+    return model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+
+class ClientPool:
+    """
+    每把 Key 一個長期使用的 Gemini client，連線建立後重複使用；同一把 Key 的 client 可同時給多位學員使用。
+    非同步 client 綁在建立它的 event loop 上，所以依 event loop 分開存放。
+    """
+
+    def __init__(self, max_size=CLIENT_POOL_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()  # (event loop 或 None, 種類, Key) → client
+        self._warmed = set()           # 已經預熱過的 (event loop, Key)
+
+    def _get(self, loop, kind, api_key, factory):
+        slot = (loop, kind, api_key)
+        with self._lock:
+            client = self._clients.get(slot)
+            if client is None:
+                client = self._clients[slot] = factory()
+                while len(self._clients) > self.max_size:
+                    # 最久沒用的 client 不再保留 (連線在回收時關閉)
+                    old_loop, _, old_key = self._clients.popitem(last=False)[0]
+                    self._warmed.discard((old_loop, old_key))
+            else:
+                self._clients.move_to_end(slot)
+            return client
+
+    def async_client(self, api_key):
+        """目前 event loop 上這把 Key 的非同步 client (必須在執行中的 event loop 裡呼叫)"""
+        from google.ai import generativelanguage as glm
+
+        return self._get(asyncio.get_running_loop(), "generate", api_key,
+                         lambda: glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key}))
+
+    def sync_client(self, api_key):
+        from google.ai import generativelanguage as glm
+
+        return self._get(None, "generate", api_key,
+                         lambda: glm.GenerativeServiceClient(client_options={"api_key": api_key}))
+
+    def model_client(self, api_key):
+        """查詢可用模型用的 client (同步)"""
+        from google.ai import generativelanguage as glm
+
+        return self._get(None, "models", api_key, lambda: glm.ModelServiceClient(client_options={"api_key": api_key}))
+
+    async def warm_up(self, api_keys, model_name):
+        """
+        先把每把 Key 的連線建好 (送一個不耗生成額度的 count_tokens)，回傳這次預熱了幾把。
+        已經預熱過的 Key 直接略過，可以每次重跑畫面都呼叫；失敗只印出錯誤，真正送出時再照常處理。
+        """
+        from google.ai import generativelanguage as glm
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pending = [key for key in dict.fromkeys(api_keys) if (loop, key) not in self._warmed]
+            self._warmed.update((loop, key) for key in pending)
+
+        async def warm(api_key):
+            try:
+                await self.async_client(api_key).count_tokens(
+                    model=_model_path(model_name),
+                    contents=[glm.Content(role="user", parts=[glm.Part(text="hi")])],
+                    timeout=WARM_UP_TIMEOUT,
+                )
+            except Exception as e:
+                print(f"API Key 連線預熱失敗: {e}")
+
+        await asyncio.gather(*(warm(key) for key in pending))
+        return len(pending)
+
+
+def list_models(api_key):
+    """這把 Key 可用來生成內容的模型名稱 (models/...)"""
+    models = clients.model_client(api_key).list_models()
+    return [m.name for m in models if "generateContent" in m.supported_generation_methods]
+
+
+def _build_model(model_name, system_prompt):
+    import google.generativeai as genai
+
+    # 將 System Prompt 綁定為 system_instruction，確保切換 Key 時學生角色絕不突變
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=system_prompt,
+        safety_settings=safety_settings(),
+    )
+
+
+def call_model(api_key, model_name, system_prompt, gemini_history, text, timeout=None):
+    """
+    (同步版，給離線批次工具用) 用指定的 Key 送出一則訊息並回傳文字。
+    使用該 Key 在 client pool 中的 client，不動全域的 genai.configure()，多執行緒同時用不同 Key 也不會互相覆蓋。
+    """
+    model = _build_model(model_name, system_prompt)
+    model._client = clients.sync_client(api_key)
+
+    chat_session = model.start_chat(history=gemini_history)
+    request_options = {"timeout": timeout} if timeout else None
+    return chat_session.send_message(text, request_options=request_options).text
+
+
+def _record_usage(api_key, requests=1, tokens=0):
+    """登記用量 (在事件迴圈中呼叫)：丟到執行緒池寫入，不等它完成"""
+    asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(key_registry.get_registry().record, api_key, requests=requests, tokens=tokens))
+
+
+def _record_tokens(api_key, response):
+    usage = getattr(response, "usage_metadata", None)
+    tokens = getattr(usage, "total_token_count", 0) if usage else 0
+    if tokens:
+        _record_usage(api_key, requests=0, tokens=tokens)
+
+
+async def generate_async(api_key, model_name, system_prompt, gemini_history, text, timeout=None):
+    """用指定的 Key 送出一則訊息，回傳完整的回應 (含 usage_metadata)；timeout 會直接交給底層連線，卡住的連線不會無限等待。"""
+    model = _build_model(model_name, system_prompt)
+    model._async_client = clients.async_client(api_key)
+
+    chat_session = model.start_chat(history=gemini_history)
+    request_options = {"timeout": timeout} if timeout else None
+    response = await chat_session.send_message_async(text, request_options=request_options)
+    _record_tokens(api_key, response)
+    return response
+
+
+async def call_model_async(api_key, model_name, system_prompt, gemini_history, text, timeout=None):
+    """用指定的 Key 送出一則訊息並回傳文字"""
+    return (await generate_async(api_key, model_name, system_prompt, gemini_history, text, timeout)).text
+
+
+async def stream_model_async(api_key, model_name, system_prompt, gemini_history, text, timeout=None):
+    """串流版的 call_model_async：模型一邊生成，一邊逐段 yield 回應文字"""
+    model = _build_model(model_name, system_prompt)
+    model._async_client = clients.async_client(api_key)
+
+    chat_session = model.start_chat(history=gemini_history)
+    request_options = {"timeout": timeout} if timeout else None
+    response = await chat_session.send_message_async(text, stream=True, request_options=request_options)
+    last_chunk = None
+    async for chunk in response:
+        last_chunk = chunk
+        if chunk.parts:
+            yield chunk.text
+    if last_chunk is not None:
+        _record_tokens(api_key, last_chunk)  # 串流的用量記在最後一段
+
+
+class LatencyTracker:
+    """各模型近期成功請求的延遲，以及備援請求所佔的比例"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}     # model_name -> deque[秒]
+        self._requests = deque()  # 近期請求的時間點
+        self._hedges = deque()    # 近期備援的時間點
+
+    def record(self, model_name, seconds):
+        with self._lock:
+            self._latencies.setdefault(model_name, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def percentile(self, model_name, q):
+        with self._lock:
+            samples = sorted(self._latencies.get(model_name, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self, model_name):
+        p90 = self.percentile(model_name, 0.9)
+        return p90 if p90 is not None else HEDGE_DEFAULT_DELAY
+
+    def count_request(self):
+        with self._lock:
+            self._requests.append(time.time())
+
+    def try_reserve_hedge(self):
+        """備援比例還沒超過上限時記下一次備援並回傳 True"""
+        with self._lock:
+            self._trim(time.time())
+            if len(self._hedges) + 1 > HEDGE_MAX_RATE * len(self._requests):
+                return False
+            self._hedges.append(time.time())
+            return True
+
+    def _trim(self, now):
+        for q in (self._requests, self._hedges):
+            while q and now - q[0] > HEDGE_RATE_WINDOW:
+                q.popleft()
+
+
+class CircuitBreaker:
+    """單一 Key 的斷路器：closed (正常) → open (斷開) → half-open (試探) → closed"""
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        if now - self.opened_at < BREAKER_COOLDOWN:
+            return "open"
+        return "half-open"
+
+
+class BreakerRegistry:
+    """所有 Key 的斷路器 (整個程序、所有學員共用)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def _get(self, api_key):
+        return self._breakers.setdefault(api_key, CircuitBreaker())
+
+    def allow(self, api_key):
+        """這把 Key 現在能不能用；half-open 時只放行一個試探請求"""
+        with self._lock:
+            breaker = self._get(api_key)
+            state = breaker.state(time.time())
+            if state == "closed":
+                return True
+            if state == "half-open" and not breaker.probing:
+                breaker.probing = True
+                return True
+            return False
+
+    def record_success(self, api_key):
+        with self._lock:
+            breaker = self._get(api_key)
+            breaker.failures = 0
+            breaker.opened_at = None
+            breaker.probing = False
+
+    def record_failure(self, api_key):
+        with self._lock:
+            breaker = self._get(api_key)
+            breaker.failures += 1
+            if breaker.probing or breaker.failures >= BREAKER_FAILURES:
+                breaker.opened_at = time.time()
+            breaker.probing = False
+
+    def release(self, api_key):
+        """請求被取消、沒有結果時，歸還試探名額"""
+        with self._lock:
+            self._get(api_key).probing = False
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {key: breaker.state(now) for key, breaker in self._breakers.items()}
+
+
+# 整個程序共用 (所有學員一起累積延遲樣本與 Key 狀態，共用連線)
+latency = LatencyTracker()
+breakers = BreakerRegistry()
+clients = ClientPool()
+
+
+async def _key_available(api_key):
+    """先看跨程序的用量登記 (冷卻中、這一分鐘已到上限)，再看本程序的斷路器 (half-open 時會佔用試探名額)"""
+    if not await asyncio.to_thread(key_registry.get_registry().allow, api_key):
+        return False
+    return breakers.allow(api_key)
+
+
+async def _record_error(api_key, model_name, exc):
+    quota_error = is_quota_error(exc)
+    model_policy.policy.record(model_name, quota_error=quota_error, model_error=not quota_error and is_model_error(exc))
+    if quota_error:
+        await asyncio.to_thread(key_registry.get_registry().cool_down, api_key)
+
+
+def _next_model(chain):
+    """模型無法使用後，改用備援鏈中下一個可用的模型；沒有備援鏈或都不能用時回傳 None"""
+    if chain is None:
+        return None
+    model_name = model_policy.policy.choose(chain)
+    return None if model_policy.policy.is_degraded(model_name) else model_name
+
+
+async def _timed_call(api_key, model_name, system_prompt, gemini_history, text, timeout):
+    _record_usage(api_key)
+    t0 = time.perf_counter()
+    try:
+        result = await call_model_async(api_key, model_name, system_prompt, gemini_history, text, timeout=timeout)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await _record_error(api_key, model_name, e)
+        raise
+    elapsed = time.perf_counter() - t0
+    latency.record(model_name, elapsed)
+    model_policy.policy.record(model_name, seconds=elapsed)
+    return result
+
+
+async def send_message(api_keys, start_index, model_name, system_prompt, gemini_history, text,
+                       hedge=False, on_key_error=None, attempt_timeout=ATTEMPT_TIMEOUT, turn_deadline=TURN_DEADLINE,
+                       fallback_models=None):
+    """
+    從 start_index 那把 Key 開始輪替送出訊息，回傳 (回應文字, 成功的 Key index, 實際使用的模型)。
+    傳入 fallback_models (備援鏈) 時，依 model_policy 的統計決定這一輪用 model_name 或降級後的模型。
+    斷路器斷開的 Key 會被跳過；每次 Key 失敗 (含逾時) 會呼叫 on_key_error(key_index, exc)。
+    全部失敗時丟出最後一個錯誤，超過總時限丟出 TurnDeadlineExceeded，沒有可用的 Key 丟出 NoKeyAvailable。
+    hedge=True 且有兩把以上 Key 時啟用備援加速。
+    模型本身無法使用時不換 Key：有備援鏈就用同一把 Key 改送下一個模型，沒有就直接丟出錯誤。
+    """
+    chain = None
+    if fallback_models is not None:
+        chain = model_policy.build_chain(model_name, fallback_models)
+        model_name = model_policy.policy.choose(chain)
+    loop = asyncio.get_running_loop()
+    total_keys = len(api_keys)
+    order = [(start_index + i) % total_keys for i in range(total_keys)]
+    deadline = loop.time() + turn_deadline
+    latency.count_request()
+    last_error = None
+
+    def start(key_index):
+        timeout = min(attempt_timeout, deadline - loop.time())
+        task = asyncio.create_task(_timed_call(api_keys[key_index], model_name, system_prompt,
+                                               gemini_history, text, timeout))
+        return task, (key_index, loop.time() + timeout)
+
+    def fail(key_index, exc):
+        breakers.record_failure(api_keys[key_index])
+        if on_key_error:
+            on_key_error(key_index, exc)
+
+    running = {}
+    try:
+        while order:
+            if loop.time() >= deadline:
+                raise TurnDeadlineExceeded(f"超過 {turn_deadline:.0f} 秒仍沒有回應")
+            key_index = order.pop(0)
+            if not await _key_available(api_keys[key_index]):
+                continue
+            task, info = start(key_index)
+            running = {task: info}
+
+            if hedge and order:
+                done, _ = await asyncio.wait([task], timeout=max(0.0, min(latency.hedge_delay(model_name), info[1] - loop.time())))
+                if not done:
+                    backup = None
+                    for k in order:
+                        if await _key_available(api_keys[k]):
+                            backup = k
+                            break
+                    if backup is not None:
+                        if latency.try_reserve_hedge():
+                            order.remove(backup)
+                            backup_task, backup_info = start(backup)
+                            running[backup_task] = backup_info
+                        else:
+                            breakers.release(api_keys[backup])
+
+            # 哪個先成功就用哪個；先回來的若是失敗或逾時，繼續等另一個
+            while running:
+                timeout = max(0.0, min(expires for _, expires in running.values()) - loop.time())
+                done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    now = loop.time()
+                    for expired in [t for t, (_, expires) in running.items() if expires <= now]:
+                        expired_index, _ = running.pop(expired)
+                        expired.cancel()
+                        last_error = AttemptTimeout(f"Key {expired_index + 1} 超過 {attempt_timeout:.0f} 秒沒有回應")
+                        model_policy.policy.record(model_name, seconds=attempt_timeout)
+                        fail(expired_index, last_error)
+                    continue
+                for finished in done:
+                    finished_index, _ = running.pop(finished)
+                    try:
+                        result = finished.result()
+                    except Exception as e:
+                        last_error = e
+                        if is_model_error(e) and not is_quota_error(e):
+                            breakers.release(api_keys[finished_index])
+                            model_name = _next_model(chain)
+                            if model_name is None:
+                                raise
+                            order.insert(0, finished_index)
+                            continue
+                        fail(finished_index, e)
+                        continue
+                    breakers.record_success(api_keys[finished_index])
+                    return result, finished_index, model_name
+    finally:
+        # 備援輸掉的、或呼叫端被取消時還在跑的請求，一律取消並歸還試探名額
+        for leftover, (leftover_index, _) in running.items():
+            leftover.cancel()
+            breakers.release(api_keys[leftover_index])
+
+    if last_error is None:
+        raise NoKeyAvailable("所有 API Key 都暫時停用中 (連續失敗或額度冷卻中)，請稍後再試")
+    if loop.time() >= deadline:
+        raise TurnDeadlineExceeded(f"超過 {turn_deadline:.0f} 秒仍沒有回應") from last_error
+    raise last_error
+
+
+async def stream_message(api_keys, start_index, model_name, system_prompt, gemini_history, text, on_chunk,
+                         on_key_error=None, attempt_timeout=ATTEMPT_TIMEOUT, turn_deadline=TURN_DEADLINE,
+                         fallback_models=None):
+    """
+    串流版的 send_message：每收到一段文字就呼叫 on_chunk(段落)，最後回傳 (完整文字, 成功的 Key index, 實際使用的模型)。
+    還沒收到任何文字前失敗會換下一把 Key 重試；已經開始輸出後才失敗則直接丟出錯誤 (送出去的段落收不回來)。
+    兩段文字之間最多等 attempt_timeout 秒。其餘 (斷路器、總時限、模型降級、模型無法使用) 與 send_message 相同。
+    """
+    chain = None
+    if fallback_models is not None:
+        chain = model_policy.build_chain(model_name, fallback_models)
+        model_name = model_policy.policy.choose(chain)
+    loop = asyncio.get_running_loop()
+    total_keys = len(api_keys)
+    order = [(start_index + i) % total_keys for i in range(total_keys)]
+    deadline = loop.time() + turn_deadline
+    latency.count_request()
+    last_error = None
+
+    while order:
+        key_index = order.pop(0)
+        api_key = api_keys[key_index]
+        if loop.time() >= deadline:
+            raise TurnDeadlineExceeded(f"超過 {turn_deadline:.0f} 秒仍沒有回應") from last_error
+        if not await _key_available(api_key):
+            continue
+
+        parts = []
+        _record_usage(api_key)
+        t0 = time.perf_counter()
+        stream = stream_model_async(api_key, model_name, system_prompt, gemini_history, text,
+                                    timeout=min(attempt_timeout, deadline - loop.time()))
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), max(0.0, min(attempt_timeout, deadline - loop.time())))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise AttemptTimeout(f"Key {key_index + 1} 超過 {attempt_timeout:.0f} 秒沒有回應")
+                parts.append(chunk)
+                on_chunk(chunk)
+        except asyncio.CancelledError:
+            breakers.release(api_key)
+            raise
+        except Exception as e:
+            if isinstance(e, AttemptTimeout):
+                model_policy.policy.record(model_name, seconds=attempt_timeout)
+            else:
+                await _record_error(api_key, model_name, e)
+            model_unavailable = not isinstance(e, AttemptTimeout) and is_model_error(e) and not is_quota_error(e)
+            if model_unavailable:
+                breakers.release(api_key)
+            else:
+                breakers.record_failure(api_key)
+                if on_key_error:
+                    on_key_error(key_index, e)
+            if parts:
+                raise
+            last_error = e
+            if model_unavailable:
+                model_name = _next_model(chain)
+                if model_name is None:
+                    raise
+                order.insert(0, key_index)
+            continue
+        finally:
+            await stream.aclose()
+
+        elapsed = time.perf_counter() - t0
+        latency.record(model_name, elapsed)
+        model_policy.policy.record(model_name, seconds=elapsed)
+        breakers.record_success(api_key)
+        return "".join(parts), key_index, model_name
+
+    if last_error is None:
+        raise NoKeyAvailable("所有 API Key 都暫時停用中 (連續失敗或額度冷卻中)，請稍後再試")
+    if loop.time() >= deadline:
+        raise TurnDeadlineExceeded(f"超過 {turn_deadline:.0f} 秒仍沒有回應") from last_error
+    raise last_error
@@ -0,0 +1,68 @@
+"""
+A/B 分流：同一份程式、同一個部署同時服務兩組學員。
+
+分流的決定順序：
+    1. 舊入口 simulator_A.py / simulator_B.py 固定的分流
+    2. 網址參數 ?variant=A
+    3. 依學員編號雜湊、按權重分配 (同一位學員每次登入都分到同一組)
+
+權重可用環境變數設定，例如 COHORT_WEIGHTS="A=3,B=1"；權重設為 0 的分流不再分配新學員 (網址指定仍有效)。
+學員所屬的分流記在個案設定 (persona["variant"]) 中，會跟著存檔、續談檔一起保存。
+"""
+import hashlib
+import os
+
+DEFAULT_TITLE = "創傷知情模擬器 (研究完全版)"
+
+VARIANTS = {
+    "A": {"title": "創傷知情模擬器 (分流A)"},
+    "B": {"title": "創傷知情模擬器 (分流B)"},
+}
+
+
+def parse_weights(spec):
+    """把 "A=3,B=1" 轉成 {"A": 3.0, "B": 1.0}；不認得的分流與格式錯誤的項目略過"""
+    weights = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip().upper()
+        if name not in VARIANTS:
+            continue
+        try:
+            weights[name] = max(0.0, float(value))
+        except ValueError:
+            continue
+    return weights
+
+
+WEIGHTS = parse_weights(os.environ.get("COHORT_WEIGHTS", "A=1,B=1"))
+
+
+def normalize(variant):
+    """有效的分流名稱 (大寫)，否則回傳 None"""
+    variant = str(variant or "").strip().upper()
+    return variant if variant in VARIANTS else None
+
+
+def assign(user_id, weights=None):
+    """依學員編號的雜湊值按權重分配分流 (結果固定)"""
+    weights = {name: w for name, w in (WEIGHTS if weights is None else weights).items() if w > 0}
+    if not weights:
+        weights = {name: 1.0 for name in VARIANTS}
+    point = int(hashlib.sha256(str(user_id).encode("utf-8")).hexdigest()[:8], 16) / 0x100000000
+    total = sum(weights.values())
+    for name in sorted(weights):
+        point -= weights[name] / total
+        if point < 0:
+            return name
+    return sorted(weights)[-1]
+
+
+def resolve(requested, user_id):
+    """指定的分流有效就用它，否則依學員編號分配"""
+    return normalize(requested) or assign(user_id)
+
+
+def page_title(variant):
+    variant = normalize(variant)
+    return VARIANTS[variant]["title"] if variant else DEFAULT_TITLE
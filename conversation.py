@@ -0,0 +1,70 @@
+"""
+一場演練的對話紀錄：角色設定 Prompt 獨立一格，之後是一則一則的對話 (Turn)。
+
+送出訊息要的 Gemini 格式、寫入研究資料庫 F 欄的文字，都在新增對話時順手接上一段，
+每一輪只需要處理新的那一則，不必把整段對話重新走一遍、重新轉換。
+"""
+import chat_engine
+import sheets_store
+
+
+class Turn:
+    """一則對話 (老師 user / 學生 assistant)；model 記錄實際回應的模型，只有學生回應才有"""
+
+    __slots__ = ("role", "content", "model")
+
+    def __init__(self, role, content, model=None):
+        self.role = role
+        self.content = content
+        self.model = model or None
+
+    def to_dict(self):
+        record = {"role": self.role, "content": self.content}
+        if self.model:
+            record["model"] = self.model
+        return record
+
+
+class Conversation:
+    __slots__ = ("system_prompt", "_turns", "_gemini", "_transcript")
+
+    def __init__(self, system_prompt, turns=()):
+        self.system_prompt = system_prompt
+        self._turns = []
+        self._gemini = []
+        # F 欄沿用舊格式：第一行是角色設定 Prompt (以老師身分記錄)，讀回時會略過
+        self._transcript = [sheets_store.format_turn("user", system_prompt)]
+        for msg in turns:
+            self.append(msg["role"], msg["content"], msg.get("model"))
+
+    def append(self, role, content, model=None):
+        turn = Turn(role, content, model)
+        self._turns.append(turn)
+        self._gemini.append(chat_engine.to_gemini_turn(role, content))
+        self._transcript.append(sheets_store.format_turn(role, content, turn.model))
+        return turn
+
+    def __len__(self):
+        return len(self._turns)
+
+    def __iter__(self):
+        return iter(self._turns)
+
+    def __getitem__(self, index):
+        return self._turns[index]
+
+    def gemini_history(self):
+        """目前為止的對話 (Gemini 格式)；回傳複本，之後新增對話不會影響已經送出的請求"""
+        return self._gemini[:]
+
+    def transcript(self, persona):
+        """寫入研究資料庫 F 欄的完整對話文字 (標頭與每則訊息的格式見 sheets_store.format_header / format_turn)"""
+        return sheets_store.format_header(persona) + "".join(self._transcript)
+
+    def to_dicts(self):
+        """不含角色設定的純對話內容 [{"role", "content", "model"}, ...]"""
+        return [turn.to_dict() for turn in self._turns]
+
+    def to_history(self):
+        """舊格式：角色設定 Prompt 當作第一則老師訊息，接著是純對話內容 (舊版 CSV 紀錄檔用)"""
+        return [{"role": "user", "content": self.system_prompt}] + self.to_dicts()
@@ -0,0 +1,236 @@
+"""
+教材讀取：把倉庫中的 PDF 轉成純文字，供角色設定 Prompt 的 [KNOWLEDGE BASE] 使用。
+
+抽出的文字會先正規化再串起來 (教材只取前 25000 字放進 Prompt，每一輪都要送一次，雜訊越少能放進去的內容越多)：
+    - 每頁重複出現的頁首/頁尾 (跨頁比對，數字視為相同) 與單獨的頁碼
+    - 斷行連字號 (exam-\\nple → example)
+    - 排版造成的斷行：中文之間直接接上，英文之間換成空白；句末的換行保留
+    - 連續空白壓成一個，中文字之間的空白移除
+
+教材是逐份讀取、讀完一份就先公開一份 (CorpusLoader)：讀到的字數夠放進 Prompt 時就能開始生成個案，
+剩下的教材在背景繼續讀，不必等全部讀完。
+
+各份教材正規化前後的字數與估計 token 數：
+    python corpus.py
+"""
+import argparse
+import glob
+import math
+import re
+import sys
+import threading
+from collections import Counter
+
+HEADER_FOOTER_LINES = 2     # 每頁頭尾各檢查幾行
+REPEAT_RATIO = 0.5          # 出現在多少比例的頁面上就視為頁首/頁尾
+MIN_PAGES_FOR_REPEAT = 3    # 少於幾頁的文件不判斷頁首/頁尾
+
+_CJK = r"\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef"
+_CJK_CHAR = re.compile(f"[{_CJK}]")
+_DIGITS = re.compile(r"\d+")
+_PAGE_NUMBER = re.compile(r"^(?:[-–—]?\s*\d{1,4}\s*[-–—]?|page\s*\d+(?:\s*(?:of|/)\s*\d+)?|第\s*\d+\s*頁|\d+\s*/\s*\d+)$", re.I)
+_SPACE_RUN = re.compile(r"[ \t\u00a0\u3000]+")
+_SPACE_AROUND_NEWLINE = re.compile(r" ?\n ?")
+_HYPHEN_BREAK = re.compile(r"([A-Za-z])-\n([a-z])")
+_CJK_SPACE = re.compile(f"(?<=[{_CJK}]) (?=[{_CJK}])")
+_CJK_WRAP = re.compile(f"(?<=[{_CJK}])(?<![。！？；：」』])\n(?=[{_CJK}])")
+_LATIN_WRAP = re.compile(r"(?<=[^\n.!?:。！？；：」』])\n(?=[^\n])")
+_BLANK_LINES = re.compile(r"\n{2,}")
+
+
+def find_pdf_files(pattern="*.pdf"):
+    return sorted(glob.glob(pattern))  # 固定順序：教材內容 (與快取、切片) 不因檔案系統的列舉順序而改變
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日文約一字一個 token，其餘約四個字元一個 token (只用來比較正規化前後)"""
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _edge_key(line):
+    return _DIGITS.sub("#", line.strip()).lower()
+
+
+def _edge_indexes(lines):
+    non_empty = [i for i, line in enumerate(lines) if line.strip()]
+    return set(non_empty[:HEADER_FOOTER_LINES] + non_empty[-HEADER_FOOTER_LINES:])
+
+
+def find_repeated_lines(pages):
+    """每頁頭尾幾行中，出現在超過 REPEAT_RATIO 頁面上的行 (以 _edge_key 比對，頁碼不同也算相同)"""
+    if len(pages) < MIN_PAGES_FOR_REPEAT:
+        return set()
+    counts = Counter()
+    for lines in pages:
+        counts.update({_edge_key(lines[i]) for i in _edge_indexes(lines)})
+    threshold = max(2, REPEAT_RATIO * len(pages))
+    return {key for key, count in counts.items() if key and count >= threshold}
+
+
+def normalize_text(text):
+    """斷行連字號、排版斷行與空白的處理 (不含頁首/頁尾)"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _SPACE_RUN.sub(" ", text)
+    text = _SPACE_AROUND_NEWLINE.sub("\n", text)
+    text = _HYPHEN_BREAK.sub(r"\1\2", text)
+    text = _CJK_SPACE.sub("", text)
+    text = _CJK_WRAP.sub("", text)
+    text = _LATIN_WRAP.sub(" ", text)
+    text = _BLANK_LINES.sub("\n", text)
+    return text.strip()
+
+
+def normalize_pages(pages):
+    """一份文件的各頁文字 → 正規化後的全文，以及移除的頁首/頁尾/頁碼行數"""
+    split = [page.splitlines() for page in pages]
+    repeated = find_repeated_lines(split)
+    removed = 0
+    kept_pages = []
+    for lines in split:
+        edges = _edge_indexes(lines)
+        kept = []
+        for i, line in enumerate(lines):
+            if i in edges and (_edge_key(line) in repeated or _PAGE_NUMBER.match(line.strip())):
+                removed += 1
+                continue
+            kept.append(line)
+        kept_pages.append("\n".join(kept))
+    return normalize_text("\n".join(kept_pages)), removed
+
+
+def extract_pages(filename):
+    from pypdf import PdfReader
+
+    return [page.extract_text() or "" for page in PdfReader(filename).pages]
+
+
+def iter_document_texts(pdf_files, normalize=True, stats=None):
+    """
+    依序讀取每份 PDF，每讀完一份就產出該份的文字 (串起來即為整份教材)。
+    stats 給一個 list 時，每份文件附上一筆正規化前後的字數與估計 token 數。
+    """
+    for filename in pdf_files:
+        pages = extract_pages(filename)
+        raw = "".join(text + "\n" for text in pages if text)
+        if normalize:
+            text, removed = normalize_pages(pages)
+            text += "\n"
+        else:
+            text, removed = raw, 0
+        if stats is not None:
+            stats.append({
+                "file": filename,
+                "pages": len(pages),
+                "raw_chars": len(raw),
+                "chars": len(text),
+                "raw_tokens": estimate_tokens(raw),
+                "tokens": estimate_tokens(text),
+                "removed_lines": removed,
+            })
+        yield text
+
+
+def load_corpus_text(pdf_files, normalize=True, stats=None):
+    """依序讀取每份 PDF，串成一份文字 (等全部讀完才回傳)"""
+    return "".join(iter_document_texts(pdf_files, normalize, stats))
+
+
+class CorpusLoader:
+    """
+    在背景執行緒逐份讀取教材，讀完一份就先公開一份：
+    text() 隨時回傳目前讀到的部分 (教材依序串接，所以是最終全文的前段)，
+    wait(min_chars) 等到讀到這麼多字 (或全部讀完) 就回傳，不必等全部讀完。
+    """
+
+    def __init__(self, pdf_files, normalize=True):
+        self.files = list(pdf_files)
+        self.normalize = normalize
+        self.loaded_files = 0
+        self.error = None
+        self._parts = []
+        self._chars = 0
+        self._text = ""
+        self._done = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="corpus-loader", daemon=True)
+                self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for text in iter_document_texts(self.files, self.normalize):
+                with self._cond:
+                    self._parts.append(text)
+                    self._chars += len(text)
+                    self._text = None
+                    self.loaded_files += 1
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+            print(f"教材讀取失敗: {e}")
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    @property
+    def done(self):
+        return self._done
+
+    @property
+    def chars(self):
+        return self._chars
+
+    def text(self):
+        """目前讀到的教材 (讀到新的一份之前，每次回傳同一個字串)"""
+        with self._cond:
+            if self._text is None:
+                self._text = "".join(self._parts)
+            return self._text
+
+    def wait(self, min_chars=None, timeout=None):
+        """等到讀到 min_chars 字 (沒給就是全部讀完) 再回傳目前的教材；逾時則回傳已經讀到的部分"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._done or (min_chars is not None and self._chars >= min_chars), timeout)
+        return self.text()
+
+
+_shared_loaders = {}
+_shared_lock = threading.Lock()
+
+
+def get_shared_loader(pattern="*.pdf"):
+    """整個程序共用的教材讀取器：每個路徑樣式只讀一次 (第一次用到時在背景開始讀)，所有學員、所有分流共用同一份"""
+    with _shared_lock:
+        if pattern not in _shared_loaders:
+            _shared_loaders[pattern] = CorpusLoader(find_pdf_files(pattern)).start()
+        return _shared_loaders[pattern]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="列出各份教材正規化前後的字數與估計 token 數")
+    parser.add_argument("--pdf-glob", default="*.pdf", help="教材 PDF 的路徑樣式")
+    args = parser.parse_args(argv)
+
+    stats = []
+    load_corpus_text(find_pdf_files(args.pdf_glob), stats=stats)
+    print(f"{'教材':<40}{'頁數':>6}{'字數 (前→後)':>22}{'估計 token (前→後)':>24}{'移除行數':>10}")
+    for s in stats:
+        saved = 1 - s["tokens"] / s["raw_tokens"] if s["raw_tokens"] else 0.0
+        print(f"{s['file'][:40]:<40}{s['pages']:>6}{s['raw_chars']:>11} → {s['chars']:<8}"
+              f"{s['raw_tokens']:>11} → {s['tokens']:<8} ({saved:.0%}){s['removed_lines']:>8}")
+    raw_tokens = sum(s["raw_tokens"] for s in stats)
+    tokens = sum(s["tokens"] for s in stats)
+    if raw_tokens:
+        print(f"\n合計估計 token：{raw_tokens} → {tokens} (節省 {1 - tokens / raw_tokens:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
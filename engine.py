@@ -0,0 +1,287 @@
+"""
+模擬器引擎：一位學員的一場演練 (ConversationSession)，與 streamlit 完全分離。
+
+    sim = ConversationSession.new_case("001", knowledge, grade="國小", lang="繁體中文")
+    sim.configure(api_keys=[...], model_name="gemini-2.5-flash")
+    await sim.start()              # 學生的開場白
+    await sim.send("(微笑) 怎麼了？")  # 老師回應 → 學生回應
+    await sim.save()               # 存到研究資料庫 (有設定 saver 時)
+
+所有方法都是 coroutine，一個 event loop 可以同時服務許多學員。
+streamlit 的腳本在各自的執行緒中執行，透過 submit() 把工作交給整個程序共用的背景 event loop。
+
+也可以不開網頁，直接在終端機演練 (方便測試)：
+    GEMINI_API_KEYS=key1,key2 python engine.py --grade 國中 --lang 繁體中文 --out 紀錄.jsonl
+"""
+import argparse
+import asyncio
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import chat_engine
+import knowledge_slices
+import model_policy
+import opening_cache
+import personas
+import response_cache
+from conversation import Conversation
+
+DEFAULT_MODEL = "gemini-2.5-flash"
+THROTTLE_SECONDS = 1.0  # [防呆] 每次呼叫前強制減速
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """整個程序共用的背景 event loop (第一次用到時才啟動)"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="sim-engine", daemon=True).start()
+        return _loop
+
+
+def submit(coro):
+    """在背景 event loop 執行 coroutine，不等待結果"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+class ConversationSession:
+    """一位學員的一場演練：個案設定、對話紀錄 (conversation.Conversation) 與發送設定"""
+
+    def __init__(self, user_id, persona, conversation, lang, start_time=None):
+        self.user_id = user_id
+        self.persona = persona
+        self.conversation = conversation
+        self.lang = lang
+        self.start_time = start_time or datetime.now()
+        self.api_keys = []
+        self.key_index = 0
+        self.model_name = DEFAULT_MODEL
+        self.last_served_model = ""
+        self.hedge = False
+        self.model_fallback = True
+        self.use_cache = False
+        self.saver = None
+        self._save_lock = None
+
+    @classmethod
+    def new_case(cls, user_id, knowledge, grade, lang,
+                 session_num=personas.DEFAULT_SESSION_NUM,
+                 relation=personas.DEFAULT_RELATION,
+                 recent_event=personas.DEFAULT_RECENT_EVENT, variant=None):
+        persona = personas.generate_random_persona(grade)
+        persona['session_num'] = session_num
+        persona['relation'] = relation
+        persona['recent_event'] = recent_event
+        if variant:
+            persona['variant'] = variant  # A/B 分流 (cohorts.py)，跟著存檔一起保存
+        sys_prompt = personas.build_system_prompt(persona, knowledge_slices.knowledge_for(persona, knowledge), lang)
+        return cls(user_id, persona, Conversation(sys_prompt), lang)
+
+    @classmethod
+    def resume(cls, user_id, persona, turns, knowledge, lang, variant=None):
+        """
+        從續談檔或雲端紀錄接續：重新組出角色設定 Prompt，接上原本的純對話內容。
+        紀錄中已有分流時沿用原本的分流 (同一個個案不會中途換組)。
+        """
+        if variant and not persona.get('variant'):
+            persona = {**persona, 'variant': variant}
+        sys_prompt = personas.build_resume_prompt(persona, knowledge_slices.knowledge_for(persona, knowledge), lang)
+        return cls(user_id, persona, Conversation(sys_prompt, turns), lang)
+
+    def to_state(self):
+        """可存成 JSON 的完整狀態 (session_store 用，內容為複本)；不含 API Key 與存檔函式"""
+        return {
+            "user_id": self.user_id,
+            "persona": dict(self.persona),
+            "system_prompt": self.conversation.system_prompt,
+            "turns": self.conversation.to_dicts(),
+            "lang": self.lang,
+            "start_time": self.start_time.isoformat(),
+            "key_index": self.key_index,
+            "model_name": self.model_name,
+            "last_served_model": self.last_served_model,
+            "hedge": self.hedge,
+            "model_fallback": self.model_fallback,
+            "use_cache": self.use_cache,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """由 to_state() 的內容接回一場演練 (API Key 與存檔函式需再以 configure() 設定)"""
+        sim = cls(state["user_id"], state["persona"], Conversation(state["system_prompt"], state["turns"]), state["lang"],
+                  datetime.fromisoformat(state["start_time"]))
+        sim.last_served_model = state.get("last_served_model", "")
+        return sim.configure(key_index=state.get("key_index"), model_name=state.get("model_name"),
+                             hedge=state.get("hedge"), model_fallback=state.get("model_fallback"),
+                             use_cache=state.get("use_cache"))
+
+    def configure(self, api_keys=None, model_name=None, hedge=None, model_fallback=None, use_cache=None,
+                  key_index=None, saver=None):
+        """套用發送設定 (只更新有給值的項目)"""
+        for name, value in (("api_keys", api_keys), ("model_name", model_name), ("hedge", hedge),
+                            ("model_fallback", model_fallback), ("use_cache", use_cache),
+                            ("key_index", key_index), ("saver", saver)):
+            if value is not None:
+                setattr(self, name, value)
+        return self
+
+    @property
+    def system_prompt(self):
+        return self.conversation.system_prompt
+
+    @property
+    def turns(self):
+        """不含角色設定的純對話內容 [{"role", "content", "model"}, ...]"""
+        return self.conversation.to_dicts()
+
+    async def start(self, on_key_error=None, on_chunk=None):
+        """學生的開場白：預設晤談情境先找離線預先產生的，找不到 (或自訂了情境) 才即時生成"""
+        text = None
+        if personas.uses_default_context(self.persona):
+            text = opening_cache.lookup(self.model_name, self.system_prompt)
+            self.last_served_model = self.model_name
+        if text:
+            if on_chunk:
+                on_chunk(text)
+        else:
+            text = await self._generate(personas.OPENING_ACTION, self.conversation.gemini_history(), on_key_error, on_chunk)
+        return self._append_reply(text)
+
+    async def send(self, text, on_key_error=None, on_chunk=None):
+        """
+        老師送出一則訊息，回傳學生回應 {"role", "content", "model"}。
+        老師的訊息會先記進對話紀錄 (失敗時也保留)；錯誤 (額度、逾時等) 直接往外丟，由呼叫端決定怎麼提示。
+        給了 on_chunk 時改用串流，學生回應每生成一段就呼叫一次 on_chunk(段落)。
+        """
+        self.conversation.append("user", text)
+        return await self.reply(on_key_error, on_chunk)
+
+    async def reply(self, on_key_error=None, on_chunk=None):
+        """
+        對最後一則老師訊息產生學生回應 (send() 因額度等原因失敗後重試用：老師的訊息已經在紀錄中，不會重複記錄)
+        """
+        gemini_history = self.conversation.gemini_history()
+        text = self.conversation[-1].content
+        return self._append_reply(await self._generate(text, gemini_history[:-1], on_key_error, on_chunk))
+
+    async def _generate(self, text, gemini_history, on_key_error, on_chunk=None):
+        # 重播模式：同樣的模型 + 角色設定 + 對話，直接用上次的回應 (不打 API、不用減速)
+        cache = response_cache.get_shared_cache() if self.use_cache else None
+        if cache:
+            cache_key = response_cache.make_key(self.model_name, self.system_prompt, gemini_history, text)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                cached_text, served_model = cached
+                self.last_served_model = served_model or self.model_name
+                if on_chunk:
+                    on_chunk(cached_text)
+                return cached_text
+
+        await asyncio.sleep(THROTTLE_SECONDS)  # [防呆] 強制減速 1 秒
+
+        fallback_models = model_policy.DEFAULT_FALLBACK_CHAIN if self.model_fallback else None
+        if on_chunk:
+            resp_text, key_index, served_model = await chat_engine.stream_message(
+                self.api_keys, self.key_index, self.model_name, self.system_prompt, gemini_history, text,
+                on_chunk, on_key_error=on_key_error, fallback_models=fallback_models,
+            )
+        else:
+            resp_text, key_index, served_model = await chat_engine.send_message(
+                self.api_keys,
+                self.key_index,
+                self.model_name,
+                self.system_prompt,
+                gemini_history,
+                text,
+                hedge=self.hedge,
+                on_key_error=on_key_error,
+                fallback_models=fallback_models,
+            )
+        # 記錄最後成功的 Key index 與實際回應的模型
+        self.key_index = key_index
+        self.last_served_model = served_model
+        if cache:
+            cache.put(cache_key, resp_text, served_model)
+        return resp_text
+
+    def _append_reply(self, text):
+        turn = self.conversation.append("assistant", text, model_policy.normalize_model_name(self.last_served_model))
+        return turn.to_dict()
+
+    def snapshot(self):
+        """目前狀態的複本 (存檔用，背景存檔時對話繼續進行也不會互相影響)"""
+        return {
+            "user_id": self.user_id,
+            "persona": dict(self.persona),
+            "full_conversation": self.conversation.transcript(self.persona),
+            "lang": self.lang,
+            "start_time": self.start_time,
+            "end_time": datetime.now(),
+        }
+
+    async def save(self):
+        """存到研究資料庫；同一場演練的存檔依序進行，避免同時新增出兩列"""
+        if self.saver is None or not self.conversation:
+            return False
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            return await asyncio.to_thread(self.saver, self.snapshot())
+
+    def save_in_background(self):
+        return submit(self.save())
+
+
+async def _cli(args):
+    import corpus
+    import session_io
+
+    api_keys = chat_engine.env_api_keys()
+    if not api_keys:
+        return 1
+    # 讀到夠放進 Prompt 的教材就開始 (其餘在背景繼續讀)
+    loader = corpus.CorpusLoader(corpus.find_pdf_files(args.pdf_glob)).start()
+    knowledge = await asyncio.to_thread(loader.wait, personas.KNOWLEDGE_CHAR_LIMIT)
+
+    sim = ConversationSession.new_case(args.user, knowledge, args.grade, args.lang)
+    sim.configure(api_keys=api_keys, model_name=args.model)
+    p = sim.persona
+    print(f"🎭 {p['grade']}生 {p['name']} | {p['background']} | {p['trigger']} | {p['response_mode']}")
+    print(f"學生> {(await sim.start())['content']}")
+    while True:
+        try:
+            text = (await asyncio.to_thread(input, "老師> ")).strip()
+        except EOFError:
+            break
+        if not text:
+            continue
+        if text in ("/quit", "/exit"):
+            break
+        print(f"學生> {(await sim.send(text))['content']}")
+
+    if args.out:
+        saved_at = (datetime.now() + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
+        with open(args.out, "wb") as f:
+            f.write(session_io.dump_session_jsonl(sim.turns, sim.persona, args.user, saved_at))
+        print(f"💾 已存成 {args.out}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在終端機進行創傷知情模擬演練")
+    parser.add_argument("--user", default="cli", help="學員編號")
+    parser.add_argument("--grade", default=personas.GRADES[0], choices=personas.GRADES)
+    parser.add_argument("--lang", default=personas.LANGUAGES[0], choices=personas.LANGUAGES)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--out", default=None, help="結束時把紀錄存成 .jsonl 續談檔")
+    parser.add_argument("--pdf-glob", default="*.pdf", help="教材 PDF 的路徑樣式")
+    return asyncio.run(_cli(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
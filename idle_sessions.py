@@ -0,0 +1,192 @@
+"""
+閒置演練的記憶體管理：記錄每場演練最後一次活動的時間，閒置超過 SESSION_IDLE_MINUTES (預設 30) 分鐘，
+就把狀態 (engine.ConversationSession.to_state()，壓縮後) 移到磁碟上的 SQLite 檔、從記憶體中移除；
+學員回來時 get() 會自動由磁碟接回，呼叫端不必知道它曾經被移出去。
+
+工作坊一整天下來，關掉分頁、沒有按結束的演練會累積好幾百場，每場都帶著幾萬字的角色設定 Prompt。
+磁碟上的狀態過了 SESSION_TTL_HOURS (見 session_store.py) 就清掉；不含 API Key 與存檔函式，接回後需再 configure()。
+"""
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import engine
+import session_store
+
+IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_MINUTES", "30")) * 60
+SPILL_PATH = os.environ.get("SESSION_SPILL_PATH", ".spilled_sessions.db")
+REAP_INTERVAL = 60.0  # 多久檢查一次閒置的演練 (秒)
+
+
+def approx_bytes(sim):
+    """一場演練大約佔多少記憶體：角色設定與對話文字 (F 欄文字另有一份，所以乘二)"""
+    conversation = sim.conversation
+    text = sys.getsizeof(conversation.system_prompt) + sum(sys.getsizeof(turn.content) for turn in conversation)
+    return 2 * text
+
+
+class SpillStore(session_store.SQLiteSessionStore):
+    """移出記憶體的演練狀態 (zlib 壓縮的 JSON)，存在本機的 SQLite 檔；接回時讀出就刪除"""
+
+    TABLE = "spilled"
+    STATE_TYPE = "BLOB"
+
+    def __init__(self, path=SPILL_PATH, ttl=session_store.SESSION_TTL):
+        super().__init__(path, ttl)
+
+    def _serialize(self, state):
+        return zlib.compress(super()._serialize(state).encode("utf-8"))
+
+    def _deserialize(self, data):
+        return super()._deserialize(zlib.decompress(data))
+
+    def take(self, session_id):
+        """讀回並刪除；沒有 (或已過期) 時回傳 None"""
+        state = self.load(session_id)
+        if state is not None:
+            self.delete(session_id)
+        return state
+
+    def count(self):
+        try:
+            return self._conn().execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+
+class SessionPool:
+    """
+    session_id → ConversationSession，附最後活動時間。
+    on_restore(sim) 在由磁碟接回時呼叫 (例如補上 API Key 與存檔函式)。
+    """
+
+    def __init__(self, spill=None, idle_timeout=IDLE_TIMEOUT, on_restore=None):
+        self.spill = spill
+        self.idle_timeout = idle_timeout
+        self.on_restore = on_restore
+        self.spilled_total = 0
+        self.restored_total = 0
+        self._entries = {}  # session_id → [sim, 最後活動時間]
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, session_id):
+        return session_id in self._entries
+
+    def put(self, session_id, sim):
+        with self._lock:
+            self._entries[session_id] = [sim, time.monotonic()]
+        return sim
+
+    def get(self, session_id):
+        """取出演練並更新活動時間；已移到磁碟的會先接回；都找不到時回傳 None"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry[1] = time.monotonic()
+                return entry[0]
+        state = self.spill.take(session_id) if self.spill is not None else None
+        if state is None:
+            return None
+        sim = engine.ConversationSession.from_state(state)
+        if self.on_restore is not None:
+            self.on_restore(sim)
+        with self._lock:
+            # 同時有兩個請求在接回同一場時，以先放回記憶體的為準
+            entry = self._entries.setdefault(session_id, [sim, time.monotonic()])
+            self.restored_total += 1
+        return entry[0]
+
+    def touch(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry[1] = time.monotonic()
+
+    def pop(self, session_id):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+        if self.spill is not None:
+            self.spill.delete(session_id)
+        return entry[0] if entry else None
+
+    def evict_idle(self, busy=None):
+        """把閒置超過時限的演練移到磁碟 (busy(session_id) 為真的略過)，回傳移出的 session_id"""
+        if self.spill is None:
+            return []
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = [(sid, entry[0]) for sid, entry in self._entries.items()
+                    if entry[1] < deadline and not (busy and busy(sid))]
+        evicted = []
+        for session_id, sim in idle:
+            if not self.spill.save(session_id, sim.to_state()):
+                continue
+            with self._lock:
+                entry = self._entries.get(session_id)
+                # 寫入磁碟的期間又有活動：留在記憶體 (磁碟上那份下次接回前會被覆寫或過期)
+                if entry is None or entry[0] is not sim or entry[1] >= deadline:
+                    continue
+                del self._entries[session_id]
+                self.spilled_total += 1
+            evicted.append(session_id)
+        return evicted
+
+    def start_reaper(self, interval=REAP_INTERVAL):
+        """背景執行緒定期移出閒置的演練 (重複呼叫只會啟動一個)"""
+        with self._lock:
+            if self._reaper is None and self.spill is not None:
+                self._reaper = threading.Thread(target=self._reap_forever, args=(interval,),
+                                                name="session-reaper", daemon=True)
+                self._reaper.start()
+        return self
+
+    def _reap_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                if self.evict_idle():
+                    stats = self.stats()
+                    print(f"閒置演練移到磁碟：記憶體中剩 {stats['resident']} 場 (約 {stats['resident_bytes'] / 2**20:.1f} MB)，"
+                          f"磁碟上 {stats['spilled']} 場")
+            except Exception as e:
+                print(f"閒置演練清理失敗: {e}")
+
+    def stats(self):
+        with self._lock:
+            sims = [entry[0] for entry in self._entries.values()]
+        return {
+            "resident": len(sims),
+            "resident_bytes": sum(approx_bytes(sim) for sim in sims),
+            "spilled": self.spill.count() if self.spill is not None else 0,
+            "spilled_total": self.spilled_total,
+            "restored_total": self.restored_total,
+        }
+
+
+def open_spill(path=SPILL_PATH):
+    """磁碟暫存；無法開啟時回傳 None (演練就一直留在記憶體)"""
+    try:
+        return SpillStore(path)
+    except sqlite3.Error as e:
+        print(f"無法開啟閒置演練暫存檔 ({path}): {e}")
+        return None
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_pool():
+    """整個程序共用的演練池 (第一次用到時開啟磁碟暫存並啟動背景清理)"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SessionPool(open_spill()).start_reaper()
+        return _shared
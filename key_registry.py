@@ -0,0 +1,228 @@
+"""
+跨程序共用的 API Key 用量登記：每把 Key 每分鐘的請求數、token 數，以及額度冷卻。
+
+同一組 Key 可能同時被好幾個程序 (網頁版、API 伺服器、多個副本) 使用，各自輪替時看不到別人的用量，
+很容易一起撞上 429。每次送出前先查這裡，被別的程序撞到 429 的 Key 所有程序都會先避開。
+
+後端以環境變數 KEY_REGISTRY 設定：
+    sqlite:///.key_usage.db    (預設) 同一台機器上的程序共用一個 SQLite 檔
+    redis://host:6379/0        跨機器共用 (需安裝 redis 套件)
+    memory                     只在本程序內統計
+每分鐘上限可用 KEY_RPM_LIMIT / KEY_TPM_LIMIT 設定 (0 表示不限制)。
+
+只記錄 Key 的雜湊值，不會把 Key 本身寫到檔案或 Redis。
+登記失敗 (檔案被鎖、Redis 斷線) 時一律放行，不影響送出訊息。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_BACKEND = os.environ.get("KEY_REGISTRY", "sqlite:///.key_usage.db")
+RPM_LIMIT = int(os.environ.get("KEY_RPM_LIMIT", "0"))   # 每把 Key 每分鐘最多幾個請求
+TPM_LIMIT = int(os.environ.get("KEY_TPM_LIMIT", "0"))   # 每把 Key 每分鐘最多幾個 token
+QUOTA_COOLDOWN = 60.0  # 撞到 429 後，所有程序暫停使用這把 Key 幾秒
+KEEP_MINUTES = 5       # 用量資料保留幾分鐘
+
+
+def key_id(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _minute(now):
+    return int(now // 60)
+
+
+class KeyRegistry:
+    """只在本程序內統計的版本，也是其他後端的共同介面"""
+
+    def __init__(self, rpm_limit=RPM_LIMIT, tpm_limit=TPM_LIMIT):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self._lock = threading.Lock()
+        self._usage = {}      # (key_id, minute) -> [requests, tokens]
+        self._cooldowns = {}  # key_id -> 恢復時間
+
+    def record(self, api_key, requests=1, tokens=0):
+        now = time.time()
+        with self._lock:
+            usage = self._usage.setdefault((key_id(api_key), _minute(now)), [0, 0])
+            usage[0] += requests
+            usage[1] += tokens
+            cutoff = _minute(now) - KEEP_MINUTES
+            for old in [k for k in self._usage if k[1] < cutoff]:
+                del self._usage[old]
+
+    def usage(self, api_key):
+        """這把 Key 目前這一分鐘的 {"requests", "tokens"} (所有程序合計)"""
+        with self._lock:
+            requests, tokens = self._usage.get((key_id(api_key), _minute(time.time())), (0, 0))
+        return {"requests": requests, "tokens": tokens}
+
+    def cool_down(self, api_key, seconds=QUOTA_COOLDOWN):
+        with self._lock:
+            self._cooldowns[key_id(api_key)] = time.time() + seconds
+
+    def cooldown_left(self, api_key):
+        with self._lock:
+            return max(0.0, self._cooldowns.get(key_id(api_key), 0) - time.time())
+
+    def allow(self, api_key):
+        """沒有在冷卻、這一分鐘也還沒用到上限"""
+        if self.cooldown_left(api_key) > 0:
+            return False
+        if not (self.rpm_limit or self.tpm_limit):
+            return True
+        usage = self.usage(api_key)
+        if self.rpm_limit and usage["requests"] >= self.rpm_limit:
+            return False
+        if self.tpm_limit and usage["tokens"] >= self.tpm_limit:
+            return False
+        return True
+
+
+class SQLiteKeyRegistry(KeyRegistry):
+    """同一台機器上的程序共用一個 SQLite 檔 (WAL 模式，每個執行緒各自一條連線)"""
+
+    def __init__(self, path, **limits):
+        super().__init__(**limits)
+        self.path = path
+        self._local = threading.local()
+        self._pruned_minute = None
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS key_usage (
+                key_id TEXT NOT NULL, minute INTEGER NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0, tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (key_id, minute)
+            );
+            CREATE TABLE IF NOT EXISTS key_cooldown (key_id TEXT PRIMARY KEY, until REAL NOT NULL);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=2.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL 模式下不必每次寫入都 fsync (斷電頂多少記最後幾筆用量)
+            self._local.conn = conn
+        return conn
+
+    def record(self, api_key, requests=1, tokens=0):
+        minute = _minute(time.time())
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO key_usage VALUES (?, ?, ?, ?) ON CONFLICT (key_id, minute) DO UPDATE SET "
+                "requests = requests + excluded.requests, tokens = tokens + excluded.tokens",
+                (key_id(api_key), minute, requests, tokens),
+            )
+            if self._pruned_minute != minute:
+                self._pruned_minute = minute
+                conn.execute("DELETE FROM key_usage WHERE minute < ?", (minute - KEEP_MINUTES,))
+        except sqlite3.Error as e:
+            print(f"Key 用量登記失敗: {e}")
+
+    def usage(self, api_key):
+        try:
+            row = self._conn().execute(
+                "SELECT requests, tokens FROM key_usage WHERE key_id = ? AND minute = ?",
+                (key_id(api_key), _minute(time.time())),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Key 用量查詢失敗: {e}")
+            row = None
+        requests, tokens = row or (0, 0)
+        return {"requests": requests, "tokens": tokens}
+
+    def cool_down(self, api_key, seconds=QUOTA_COOLDOWN):
+        try:
+            self._conn().execute(
+                "INSERT INTO key_cooldown VALUES (?, ?) ON CONFLICT (key_id) DO UPDATE SET until = excluded.until",
+                (key_id(api_key), time.time() + seconds),
+            )
+        except sqlite3.Error as e:
+            print(f"Key 用量登記失敗: {e}")
+
+    def cooldown_left(self, api_key):
+        try:
+            row = self._conn().execute("SELECT until FROM key_cooldown WHERE key_id = ?", (key_id(api_key),)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Key 用量查詢失敗: {e}")
+            row = None
+        return max(0.0, row[0] - time.time()) if row else 0.0
+
+
+class RedisKeyRegistry(KeyRegistry):
+    """跨機器共用 (Redis 或相容的服務)"""
+
+    def __init__(self, url, prefix="trauma-sim", **limits):
+        super().__init__(**limits)
+        import redis
+
+        self._redis = redis.Redis.from_url(url, socket_timeout=1.0)
+        self.prefix = prefix
+
+    def _usage_key(self, api_key, minute):
+        return f"{self.prefix}:usage:{key_id(api_key)}:{minute}"
+
+    def _cooldown_key(self, api_key):
+        return f"{self.prefix}:cooldown:{key_id(api_key)}"
+
+    def record(self, api_key, requests=1, tokens=0):
+        name = self._usage_key(api_key, _minute(time.time()))
+        try:
+            pipe = self._redis.pipeline()
+            pipe.hincrby(name, "requests", requests)
+            pipe.hincrby(name, "tokens", tokens)
+            pipe.expire(name, KEEP_MINUTES * 60)
+            pipe.execute()
+        except Exception as e:
+            print(f"Key 用量登記失敗: {e}")
+
+    def usage(self, api_key):
+        try:
+            values = self._redis.hmget(self._usage_key(api_key, _minute(time.time())), "requests", "tokens")
+        except Exception as e:
+            print(f"Key 用量查詢失敗: {e}")
+            values = (None, None)
+        return {"requests": int(values[0] or 0), "tokens": int(values[1] or 0)}
+
+    def cool_down(self, api_key, seconds=QUOTA_COOLDOWN):
+        try:
+            self._redis.set(self._cooldown_key(api_key), 1, px=int(seconds * 1000))
+        except Exception as e:
+            print(f"Key 用量登記失敗: {e}")
+
+    def cooldown_left(self, api_key):
+        try:
+            ms = self._redis.pttl(self._cooldown_key(api_key))
+        except Exception as e:
+            print(f"Key 用量查詢失敗: {e}")
+            return 0.0
+        return ms / 1000 if ms and ms > 0 else 0.0
+
+
+def open_registry(backend=DEFAULT_BACKEND):
+    """依設定字串建立登記後端；無法開啟時退回只在本程序內統計"""
+    try:
+        if backend.startswith("sqlite:///"):
+            return SQLiteKeyRegistry(backend[len("sqlite:///"):])
+        if backend.startswith(("redis://", "rediss://")):
+            return RedisKeyRegistry(backend)
+    except Exception as e:
+        print(f"無法開啟 Key 用量登記 ({backend})，改為只在本程序內統計: {e}")
+    return KeyRegistry()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_registry():
+    """整個程序共用的登記 (第一次用到時才開啟)"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = open_registry()
+        return _shared
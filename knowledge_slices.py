@@ -0,0 +1,157 @@
+"""
+依個案情境預先挑好的教材段落：角色設定 Prompt 的 [KNOWLEDGE BASE] 不再一律取教材最前面的 25000 字，
+而是依個案的「背景 × 觸發 × 反應」(4 × 4 × 4 = 64 種) 挑出最相關的段落。
+
+離線產生 (教材更新後重跑一次即可)：
+    python knowledge_slices.py --token-budget 6000
+
+線上組 Prompt 時只是查表；同一種情境的個案共用同一份段落 (同一個字串)，
+回應快取與開場白快取的 Prompt 也因此一致。教材變了 (指紋不符)、還在背景讀取中或段落檔還沒產生時，沿用原本取前段的做法。
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+
+import corpus
+import personas
+
+SLICES_PATH = "knowledge_slices.json"
+TOKEN_BUDGET = 6000      # 每份段落的估計 token 上限 (同時不超過 personas.KNOWLEDGE_CHAR_LIMIT 字)
+PASSAGE_CHARS = 800      # 教材切成多長的段落來評分
+SCENARIO_WEIGHT = 3      # 情境關鍵字的權重 (一般關鍵字為 1)
+
+# 各情境的關鍵字 (教材有中有英，兩種都列；英文比對不分大小寫，可只寫字首)
+KEYWORDS = {
+    "長期被忽視": ["neglect", "忽視", "attachment", "依附", "unmet need", "belonging", "歸屬"],
+    "目睹家暴": ["domestic violence", "家暴", "家庭暴力", "witness", "目睹", "hypervigilan", "過度警覺", "fear", "恐懼"],
+    "照顧者情緒不穩": ["caregiver", "照顧者", "unpredictab", "不可預測", "co-regulat", "共同調節", "attachment", "依附"],
+    "曾受肢體暴力": ["physical abuse", "肢體暴力", "abuse", "虐待", "threat", "威脅", "body", "身體"],
+    "被當眾糾正": ["shame", "羞愧", "public", "當眾", "correct", "糾正", "discipline", "管教"],
+    "感覺不公平": ["fair", "公平", "justice", "正義", "consisten", "一致", "trust", "信任"],
+    "環境吵雜": ["sensory", "感官", "noise", "吵雜", "environment", "環境", "calm", "平靜"],
+    "被誤會": ["misunderst", "誤會", "listen", "傾聽", "validat", "同理", "empath", "perspective"],
+    personas.RESPONSES[0]: ["fight", "anger", "憤怒", "aggress", "攻擊", "defian", "頂嘴", "de-escalat", "降溫"],
+    personas.RESPONSES[1]: ["flight", "avoid", "逃避", "withdraw", "退縮", "escape"],
+    personas.RESPONSES[2]: ["freeze", "凍結", "shut down", "dissociat", "解離", "numb", "呆滯"],
+    personas.RESPONSES[3]: ["fawn", "討好", "people-pleas", "apolog", "道歉", "perfection", "complian"],
+}
+GENERAL_KEYWORDS = ["trauma", "創傷", "safe", "安全", "relationship", "關係", "regulat", "調節", "strength", "優勢"]
+
+_lock = threading.Lock()
+_slices = None
+_slices_mtime = None
+_fingerprint_memo = (None, None)  # (教材字串, 指紋)：同一份共用教材只算一次
+
+
+def scenario_key(persona):
+    return "|".join((persona["background"], persona["trigger"], persona["response_mode"]))
+
+
+def iter_scenarios():
+    for background in personas.BACKGROUNDS:
+        for trigger in personas.TRIGGERS:
+            for response_mode in personas.RESPONSES:
+                yield {"background": background, "trigger": trigger, "response_mode": response_mode}
+
+
+def fingerprint(knowledge):
+    global _fingerprint_memo
+    memo_text, memo_value = _fingerprint_memo
+    if memo_text is knowledge:
+        return memo_value
+    value = hashlib.sha256(knowledge.encode("utf-8")).hexdigest()[:16]
+    _fingerprint_memo = (knowledge, value)
+    return value
+
+
+def split_passages(knowledge, size=PASSAGE_CHARS):
+    """依換行把教材切成約 size 字的段落 (保留原本順序)"""
+    passages, current = [], ""
+    for line in knowledge.split("\n"):
+        if current and len(current) + len(line) > size:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        passages.append(current)
+    return passages
+
+
+def score(passage, keywords):
+    text = passage.lower()
+    return sum(text.count(word.lower()) for word in keywords)
+
+
+def select_excerpt(passages, scenario_keywords, token_budget=TOKEN_BUDGET, char_limit=personas.KNOWLEDGE_CHAR_LIMIT):
+    """分數高的段落優先放入，直到預算用完；不足時以教材前段補滿；最後依原本順序串起來"""
+    scores = [SCENARIO_WEIGHT * score(p, scenario_keywords) + score(p, GENERAL_KEYWORDS) for p in passages]
+    ranked = sorted((i for i, s in enumerate(scores) if s > 0), key=lambda i: (-scores[i], i))
+    chosen, tokens, chars = set(), 0, 0
+    for i in ranked + [i for i in range(len(passages)) if scores[i] == 0]:
+        cost = corpus.estimate_tokens(passages[i])
+        if tokens + cost > token_budget or chars + len(passages[i]) + 1 > char_limit:
+            continue
+        chosen.add(i)
+        tokens += cost
+        chars += len(passages[i]) + 1
+    return "\n".join(passages[i] for i in sorted(chosen))
+
+
+def build_slices(knowledge, token_budget=TOKEN_BUDGET):
+    passages = split_passages(knowledge)
+    slices = {}
+    for scenario in iter_scenarios():
+        scenario_keywords = [word for field in scenario.values() for word in KEYWORDS.get(field, [])]
+        slices[scenario_key(scenario)] = select_excerpt(passages, scenario_keywords, token_budget)
+    return {"fingerprint": fingerprint(knowledge), "token_budget": token_budget, "slices": slices}
+
+
+def load_slices(path=SLICES_PATH):
+    """讀取段落檔；同一個程序只在檔案更新時重新讀取"""
+    global _slices, _slices_mtime
+    with _lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return {}
+        if _slices is None or mtime != _slices_mtime:
+            with open(path, encoding="utf-8") as f:
+                _slices = json.load(f)
+            _slices_mtime = mtime
+        return _slices
+
+
+def knowledge_for(persona, knowledge, path=SLICES_PATH):
+    """這個個案要放進 Prompt 的教材：有對應的預選段落 (且教材沒變) 就用它，否則沿用整份教材"""
+    data = load_slices(path)
+    if not data or not knowledge or data.get("fingerprint") != fingerprint(knowledge):
+        return knowledge
+    return data["slices"].get(scenario_key(persona), knowledge)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="依個案情境預先挑選教材段落")
+    parser.add_argument("--token-budget", type=int, default=TOKEN_BUDGET, help="每份段落的估計 token 上限")
+    parser.add_argument("--output", default=SLICES_PATH, help="段落檔路徑")
+    parser.add_argument("--pdf-glob", default="*.pdf", help="教材 PDF 的路徑樣式")
+    args = parser.parse_args(argv)
+
+    knowledge = corpus.load_corpus_text(corpus.find_pdf_files(args.pdf_glob))
+    if not knowledge:
+        print("❌ 找不到教材 PDF", file=sys.stderr)
+        return 1
+    data = build_slices(knowledge, args.token_budget)
+    tmp = f"{args.output}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, args.output)
+    sizes = [len(text) for text in data["slices"].values()]
+    print(f"✅ 產生 {len(sizes)} 種情境的教材段落 (每份 {min(sizes)}~{max(sizes)} 字)，寫入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
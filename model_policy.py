@@ -0,0 +1,108 @@
+"""
+模型自動降級：追蹤各模型近期的延遲與 429 (額度) 比例，
+選用的模型太慢或額度吃緊時，新的對話回合改用備援鏈中下一個較快/較便宜的模型，冷卻後自動恢復。
+模型本身無法使用 (不存在、這組 Key 沒有權限) 時立刻停用 UNAVAILABLE_SECONDS 秒，不必等累積樣本。
+
+備援鏈可用環境變數設定 (逗號分隔，依序降級)：
+    MODEL_FALLBACK_CHAIN="gemini-2.5-flash-lite,gemini-2.0-flash"
+側邊欄選的模型永遠排在最前面。整個程序共用一份統計。
+"""
+import os
+import threading
+import time
+from collections import deque
+
+DEFAULT_FALLBACK_CHAIN = [
+    m.strip() for m in os.environ.get("MODEL_FALLBACK_CHAIN", "gemini-2.5-flash-lite,gemini-2.0-flash").split(",")
+    if m.strip()
+]
+
+WINDOW_SECONDS = 300           # 統計視窗 (秒)
+MIN_SAMPLES = 5                # 至少幾筆樣本才判斷
+LATENCY_P90_THRESHOLD = 20.0   # p90 延遲超過幾秒就降級
+QUOTA_RATE_THRESHOLD = 0.3     # 429 比例超過多少就降級
+RECOVERY_SECONDS = 180         # 降級後多久再試原本的模型
+UNAVAILABLE_SECONDS = 1800     # 模型無法使用 (404 等) 時停用多久
+
+
+def normalize_model_name(model_name):
+    # selectbox 回傳的是 "models/gemini-2.5-flash"，預設值與設定檔則是 "gemini-2.5-flash"
+    return model_name.split("/", 1)[1] if model_name.startswith("models/") else model_name
+
+
+def build_chain(selected_model, fallbacks=None):
+    """選用的模型在前，接著是備援鏈 (去除重複)"""
+    chain = [selected_model]
+    seen = {normalize_model_name(selected_model)}
+    for model in DEFAULT_FALLBACK_CHAIN if fallbacks is None else fallbacks:
+        if normalize_model_name(model) not in seen:
+            seen.add(normalize_model_name(model))
+            chain.append(model)
+    return chain
+
+
+class ModelPolicy:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}         # model -> deque[(時間, 秒數或 None, 是否為額度錯誤)]
+        self._degraded_until = {}  # model -> 恢復時間
+        self._reasons = {}         # model -> 降級原因 (顯示用)
+
+    def record(self, model_name, seconds=None, quota_error=False, model_error=False):
+        """
+        記錄一次嘗試的結果：成功給 seconds，失敗給 quota_error (逾時請以 seconds=逾時秒數記錄)。
+        model_error=True 表示模型本身無法使用，直接停用這個模型。
+        """
+        model = normalize_model_name(model_name)
+        now = time.time()
+        with self._lock:
+            if model_error:
+                self._degraded_until[model] = now + UNAVAILABLE_SECONDS
+                self._reasons[model] = "模型無法使用"
+                return
+            samples = self._samples.setdefault(model, deque())
+            samples.append((now, seconds, quota_error))
+            self._evaluate(model, now)
+
+    def _evaluate(self, model, now):
+        samples = self._samples[model]
+        while samples and now - samples[0][0] > WINDOW_SECONDS:
+            samples.popleft()
+        if len(samples) < MIN_SAMPLES:
+            return
+        quota_rate = sum(1 for _, _, q in samples if q) / len(samples)
+        latencies = sorted(s for _, s, _ in samples if s is not None)
+        p90 = latencies[min(len(latencies) - 1, int(0.9 * len(latencies)))] if latencies else 0.0
+        if quota_rate > QUOTA_RATE_THRESHOLD:
+            reason = f"429 比例 {quota_rate:.0%}"
+        elif p90 > LATENCY_P90_THRESHOLD:
+            reason = f"p90 延遲 {p90:.1f} 秒"
+        else:
+            return
+        self._degraded_until[model] = now + RECOVERY_SECONDS
+        self._reasons[model] = reason
+        samples.clear()  # 恢復後重新累積證據
+
+    def is_degraded(self, model_name):
+        model = normalize_model_name(model_name)
+        with self._lock:
+            return time.time() < self._degraded_until.get(model, 0)
+
+    def choose(self, chain):
+        """回傳備援鏈中第一個沒有被降級的模型；全部都降級時用最後一個"""
+        for model in chain:
+            if not self.is_degraded(model):
+                return model
+        return chain[-1]
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {
+                model: {"seconds_left": round(until - now), "reason": self._reasons.get(model, "")}
+                for model, until in self._degraded_until.items() if until > now
+            }
+
+
+# 整個程序共用
+policy = ModelPolicy()
@@ -0,0 +1,156 @@
+"""
+開場白快取：離線預先產生每種個案組合的學生第一句話，按下「生成案例並開始」時直接取用。
+
+個案空間是有限的 (6 名字 × 4 背景 × 4 觸發 × 4 反應 × 3 年級 × 3 語言)，
+只要沿用預設晤談情境 (第 1 次、初次見面、無特殊事件)，同一組合的角色設定 Prompt 完全相同，
+因此以「模型名稱 + 角色設定 Prompt」的雜湊當索引；教材或 Prompt 一改，雜湊自然失效，不會拿到過期內容。
+自訂了晤談情境時仍走即時生成。
+
+批次產生：
+    GEMINI_API_KEYS=key1,key2 python opening_cache.py --model gemini-2.5-flash --per-combo 3
+    python opening_cache.py --grades 國小 --langs 繁體中文 --limit 20   # 只跑一部分
+已產生足夠數量的組合會自動略過，中斷後重跑即可接續。
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import personas
+from model_policy import normalize_model_name
+
+CACHE_PATH = "opening_cache.json"
+OPENINGS_PER_COMBO = 3
+
+_lock = threading.Lock()
+_cache = None
+_cache_mtime = None
+
+
+def cache_key(model_name, system_prompt):
+    raw = f"{normalize_model_name(model_name)}\0{system_prompt}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def load_cache(path=CACHE_PATH):
+    """讀取快取檔；同一個程序只在檔案更新時重新讀取"""
+    global _cache, _cache_mtime
+    with _lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return {}
+        if _cache is None or mtime != _cache_mtime:
+            with open(path, encoding="utf-8") as f:
+                _cache = json.load(f)
+            _cache_mtime = mtime
+        return _cache
+
+
+def lookup(model_name, system_prompt, path=CACHE_PATH):
+    """隨機取一句預先產生的開場白；沒有就回傳 None (呼叫端改走即時生成)"""
+    openings = load_cache(path).get(cache_key(model_name, system_prompt))
+    return random.choice(openings) if openings else None
+
+
+def iter_combinations(grades=None, langs=None):
+    """列出所有 (個案, 語言) 組合，晤談情境一律使用預設值"""
+    for grade, lang, name, background, trigger, response_mode in itertools.product(
+        grades or personas.GRADES,
+        langs or personas.LANGUAGES,
+        personas.NAMES,
+        personas.BACKGROUNDS,
+        personas.TRIGGERS,
+        personas.RESPONSES,
+    ):
+        yield {
+            "name": name,
+            "background": background,
+            "trigger": trigger,
+            "response_mode": response_mode,
+            "grade": grade,
+            "session_num": personas.DEFAULT_SESSION_NUM,
+            "relation": personas.DEFAULT_RELATION,
+            "recent_event": personas.DEFAULT_RECENT_EVENT,
+        }, lang
+
+
+def generate_opening(model_name, system_prompt, api_key):
+    import chat_engine
+    return chat_engine.call_model(api_key, model_name, system_prompt, [], personas.OPENING_ACTION)
+
+
+def _write_cache(cache, path):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="離線預先產生各個案組合的開場白")
+    parser.add_argument("--model", default="gemini-2.5-flash", help="要使用的模型 (需與線上選用的相同)")
+    parser.add_argument("--per-combo", type=int, default=OPENINGS_PER_COMBO, help="每個組合產生幾句開場白")
+    parser.add_argument("--grades", nargs="*", default=None, help="只產生指定年級")
+    parser.add_argument("--langs", nargs="*", default=None, help="只產生指定語言")
+    parser.add_argument("--limit", type=int, default=None, help="最多處理幾個組合")
+    parser.add_argument("--sleep", type=float, default=1.0, help="每次呼叫之間的間隔秒數 (防超速)")
+    parser.add_argument("--output", default=CACHE_PATH, help="快取檔路徑")
+    parser.add_argument("--pdf-glob", default="*.pdf", help="教材 PDF 的路徑樣式")
+    args = parser.parse_args(argv)
+
+    import chat_engine
+    api_keys = chat_engine.env_api_keys()
+    if not api_keys:
+        return 1
+
+    import corpus
+    import knowledge_slices
+    knowledge = corpus.load_corpus_text(corpus.find_pdf_files(args.pdf_glob))
+    if not knowledge:
+        print("⚠️ 找不到教材 PDF，產生的開場白將無法對應線上的 Prompt。", file=sys.stderr)
+
+    try:
+        with open(args.output, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    key_index = 0
+    done = generated = 0
+    combos = itertools.islice(iter_combinations(args.grades, args.langs), args.limit)
+    for persona, lang in combos:
+        # 與線上相同：有預選的教材段落就用它 (請先跑 knowledge_slices.py)
+        system_prompt = personas.build_system_prompt(persona, knowledge_slices.knowledge_for(persona, knowledge), lang)
+        key = cache_key(args.model, system_prompt)
+        openings = cache.setdefault(key, [])
+        while len(openings) < args.per_combo:
+            # 失敗時換下一把 Key，全部失敗就暫停後重試
+            for attempt in range(len(api_keys)):
+                try:
+                    openings.append(generate_opening(args.model, system_prompt, api_keys[key_index]))
+                    generated += 1
+                    break
+                except Exception as e:
+                    print(f"⚠️ Key {key_index + 1} 發生狀況：{e}", file=sys.stderr)
+                    key_index = (key_index + 1) % len(api_keys)
+            else:
+                time.sleep(60)
+            time.sleep(args.sleep)
+        done += 1
+        if generated and done % 20 == 0:
+            _write_cache(cache, args.output)
+            print(f"… 已完成 {done} 個組合，新增 {generated} 句開場白")
+
+    _write_cache(cache, args.output)
+    print(f"✅ 完成 {done} 個組合，新增 {generated} 句開場白，寫入 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+研究資料的本機副本：把研究資料庫 (「2025創傷知情研習數據」的 Simulator 工作表) 增量同步成本機的 Parquet，
+分析時讀本機檔案即可，不必每次下載整張表 (每場演練都有一格好幾 KB 的完整對話，表只會越來越大)。
+
+    GCP_SERVICE_ACCOUNT=service_account.json python research_sync.py           # 增量同步
+    GCP_SERVICE_ACCOUNT=service_account.json python research_sync.py --full    # 全部重抓
+    python research_sync.py --compact                                          # 把歷次同步合併成一個檔
+
+增量的做法：
+    - 先只讀 A~C 欄 (登入時間、最後更新時間、學員編號)，跟上次同步記下的「最後更新時間」比對，
+      找出新增的列與對話有更新的列
+    - 只抓這些列，相鄰的列合併成一段範圍，一個請求批次讀多段
+    - 拆成一則對話一列 (F 欄的 "[role]: content" 格式)，附上個案設定，寫成一個新的 Parquet 檔 (part-XXXXX.parquet)
+
+同一場演練更新過就會出現在較新的檔案中；load_turns() 每場只取最新一次同步的內容：
+    import research_sync
+    df = research_sync.load_turns()
+需要 pandas 與 pyarrow (streamlit 已經會一起安裝 pyarrow)。
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from datetime import datetime
+
+import sheets_store
+
+DATA_DIR = "research_data"
+STATE_FILE = "sync_state.json"
+RANGES_PER_REQUEST = 100  # 一個 batch_get 最多帶幾段範圍
+PERSONA_FIELDS = ("name", "grade", "background", "trigger", "response_mode", "session_num", "relation", "recent_event",
+                  "variant")
+
+
+def load_state(data_dir=DATA_DIR):
+    try:
+        with open(os.path.join(data_dir, STATE_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"sync_id": 0, "sessions": {}}
+
+
+def save_state(state, data_dir=DATA_DIR):
+    path = os.path.join(data_dir, STATE_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def find_changed_rows(worksheet, state):
+    """只讀 A~C 欄，回傳新增或最後更新時間有變的列號"""
+    changed = []
+    for i, values in enumerate(worksheet.get("A2:C"), start=2):
+        values = sheets_store.pad_row(values)
+        if not values[0]:
+            continue
+        session_id = sheets_store.make_session_id(str(values[2]), str(values[0]))
+        if state["sessions"].get(session_id) != str(values[1]):
+            changed.append(i)
+    return changed
+
+
+def group_ranges(rows):
+    """排序好的列號合併成連續的範圍 [(起, 迄), ...]"""
+    ranges = []
+    for row in rows:
+        if ranges and row == ranges[-1][1] + 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return [tuple(r) for r in ranges]
+
+
+def fetch_rows(worksheet, rows):
+    """批次讀取指定的列 (每個請求最多 RANGES_PER_REQUEST 段範圍)，回傳 [(列號, A~G 欄的值), ...]"""
+    ranges = group_ranges(rows)
+    fetched = []
+    for i in range(0, len(ranges), RANGES_PER_REQUEST):
+        chunk = ranges[i:i + RANGES_PER_REQUEST]
+        value_ranges = worksheet.batch_get([f"A{start}:{sheets_store.LAST_COLUMN}{end}" for start, end in chunk])
+        for (start, _), values in zip(chunk, value_ranges):
+            fetched.extend((start + offset, sheets_store.pad_row(v)) for offset, v in enumerate(values) if any(v))
+    return fetched
+
+
+def turn_records(values, sync_id):
+    """一列紀錄拆成一則對話一筆 (附上演練與個案設定的欄位)"""
+    record = sheets_store.parse_row(values)
+    persona = record["persona"]
+    base = {
+        "sync_id": sync_id,
+        "session_id": record["session_id"],
+        "user_id": record["user_id"],
+        "login": record["login"],
+        "updated": record["updated"],
+        **{f"persona_{field}": str(persona.get(field, "")) for field in PERSONA_FIELDS},
+    }
+    return [{**base, "turn": i, "role": turn["role"], "model": turn.get("model", ""), "content": turn["content"]}
+            for i, turn in enumerate(record["turns"])]
+
+
+def sync(worksheet, data_dir=DATA_DIR, full=False):
+    """同步一次，回傳 (更新的演練場數, 寫入的對話則數)"""
+    import pandas as pd
+
+    os.makedirs(data_dir, exist_ok=True)
+    state = {"sync_id": load_state(data_dir)["sync_id"], "sessions": {}} if full else load_state(data_dir)
+    changed = find_changed_rows(worksheet, state)
+    if not changed:
+        return 0, 0
+
+    sync_id = state["sync_id"] + 1
+    records = []
+    sessions = {}
+    for _, values in fetch_rows(worksheet, changed):
+        records.extend(turn_records(values, sync_id))
+        sessions[sheets_store.make_session_id(str(values[2]), str(values[0]))] = str(values[1])
+    if records:
+        pd.DataFrame(records).to_parquet(os.path.join(data_dir, f"part-{sync_id:05d}.parquet"), index=False)
+    # 資料檔寫好之後才更新進度，中途失敗時下次會重抓
+    state["sync_id"] = sync_id
+    state["sessions"].update(sessions)
+    state["synced_at"] = datetime.now().isoformat(timespec="seconds")
+    save_state(state, data_dir)
+    return len(sessions), len(records)
+
+
+def load_turns(data_dir=DATA_DIR):
+    """讀取本機副本 (一則對話一列)；同一場演練只保留最新一次同步的內容"""
+    import pandas as pd
+
+    parts = sorted(glob.glob(os.path.join(data_dir, "part-*.parquet")))
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(path) for path in parts], ignore_index=True)
+    latest = df.groupby("session_id")["sync_id"].transform("max")
+    return df[df["sync_id"] == latest].sort_values(["session_id", "turn"]).reset_index(drop=True)
+
+
+def compact(data_dir=DATA_DIR):
+    """把歷次同步合併成一個檔 (去掉被更新取代的舊內容)，回傳合併了幾個檔"""
+    parts = sorted(glob.glob(os.path.join(data_dir, "part-*.parquet")))
+    if len(parts) < 2:
+        return 0
+    df = load_turns(data_dir)
+    # 合併後的檔名沿用最新一次同步的編號，之後的同步照常往後接
+    merged = parts[-1]
+    df.to_parquet(f"{merged}.tmp", index=False)
+    for path in parts:
+        os.remove(path)
+    os.replace(f"{merged}.tmp", merged)
+    return len(parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把研究資料庫增量同步成本機的 Parquet")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="本機副本的資料夾")
+    parser.add_argument("--full", action="store_true", help="忽略上次的進度，全部重抓")
+    parser.add_argument("--compact", action="store_true", help="不同步，只把歷次同步合併成一個檔")
+    args = parser.parse_args(argv)
+
+    if args.compact:
+        print(f"🗜️ 合併了 {compact(args.data_dir)} 個檔")
+        return 0
+    if not os.environ.get("GCP_SERVICE_ACCOUNT"):
+        print("❌ 請以環境變數 GCP_SERVICE_ACCOUNT 指定研究資料庫的服務帳戶憑證檔", file=sys.stderr)
+        return 1
+    with open(os.environ["GCP_SERVICE_ACCOUNT"], encoding="utf-8") as f:
+        worksheet = sheets_store.connect(json.load(f))
+
+    sessions, turns = sync(worksheet, args.data_dir, full=args.full)
+    if sessions:
+        print(f"✅ 同步了 {sessions} 場演練 ({turns} 則對話)，存在 {args.data_dir}/")
+    else:
+        print("✅ 沒有新的或更新的紀錄")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+回應快取：同一個模型、同一份角色設定、同一段對話，直接回傳上次的學生回應。
+每筆記下回應文字與實際回應的模型 (模型降級時可能不是選用的模型)，重播時紀錄中的模型才會正確。
+
+給講師示範、回歸測試與重複演練腳本使用 (側邊欄「重播模式」開啟時才生效)。
+記憶體內為 LRU，另可寫入磁碟 (RESPONSE_CACHE_DIR)，磁碟超過容量時刪除最久沒用到的檔案。
+整個程序共用一份，所有學員的命中/未命中次數一起統計。
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_DISK_DIR = os.environ.get("RESPONSE_CACHE_DIR", ".response_cache")
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_MAX_DISK_BYTES = 50 * 1024 * 1024
+
+
+def make_key(model_name, system_instruction, history, text):
+    """以模型名稱、角色設定、對話歷史與這次的輸入算出內容雜湊"""
+    payload = json.dumps([model_name, system_instruction, history, text], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, disk_dir=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(e.stat().st_size for e in os.scandir(disk_dir) if e.is_file())
+
+    def get(self, key):
+        """回傳 (回應文字, 實際回應的模型)；沒有時回傳 None"""
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return self._mem[key]
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key, text, model=None):
+        entry = (text, model)
+        with self._lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "entries": len(self._mem),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _remember(self, key, entry):
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(path)  # 更新存取時間，淘汰時才知道誰最近用過
+            return data["text"], data.get("model")
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        text, model = entry
+        data = json.dumps({"text": text, "model": model}, ensure_ascii=False).encode("utf-8")
+        try:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"回應快取寫入失敗: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += len(data) - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        # 依最後使用時間由舊到新刪除，直到低於容量的八成 (舊版只存文字的 .txt 也一併淘汰)
+        entries = sorted(
+            (e for e in os.scandir(self.disk_dir) if e.is_file() and e.name.endswith((".json", ".txt"))),
+            key=lambda e: e.stat().st_mtime,
+        )
+        target = self.max_disk_bytes * 0.8
+        for entry in entries:
+            if self._disk_bytes <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_bytes -= size
+            except OSError:
+                pass
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """整個程序共用的快取 (所有學員、所有分流共用)"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ResponseCache(disk_dir=DEFAULT_DISK_DIR)
+        return _shared
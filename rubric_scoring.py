@@ -0,0 +1,262 @@
+"""
+批次評分：研習結束後，把研究資料庫中所有演練的老師回應，依創傷知情的評分規準逐則評分，
+結果一次寫回同一份試算表的「Rubric」工作表 (也可另存 CSV)，不必再人工逐則看。
+
+    GEMINI_API_KEYS=key1,key2 GCP_SERVICE_ACCOUNT=service_account.json \\
+        python rubric_scoring.py --workers 4 --rpm 30 --csv rubric.csv
+
+流程：
+    1. 整張「Simulator」工作表一次讀回，拆出每一則老師訊息 (附上前一句學生的話當情境)
+    2. 先用本機規則略過不需要評分的訊息 (只有動作、太短、單純附和)，不耗用 API 額度
+    3. 其餘交給模型評分：多個執行緒同時進行，整體請求速度以 --rpm 限制，Key 依序輪流
+    4. 每評完一則就記到進度檔 (--checkpoint)；中斷後重跑會略過已完成的，只補評剩下的
+    5. 全部完成後一次寫回
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import chat_engine
+import key_registry
+import sheets_store
+
+CHECKPOINT_PATH = "rubric_checkpoint.jsonl"
+RESULT_WORKSHEET = "Rubric"
+DEFAULT_MODEL = "gemini-2.5-flash"
+MIN_SCORABLE_CHARS = 4   # 去掉括號動作與標點後少於幾個字就不評分
+MAX_SCORE = 2
+
+# 評分規準 (每項 0~2 分)
+RUBRIC = {
+    "safety": "安全感：語氣平穩、不威脅，讓學生感到身心安全",
+    "validation": "情緒確認：辨識並接納學生的情緒，或行為背後的需要",
+    "choice": "選擇與賦權：給學生選擇、邀請合作，而不是命令",
+    "non_punitive": "不羞辱、不懲罰：避免當眾糾正、責備或貼標籤",
+    "regulation": "協助調節：放慢步調、共同調節，幫助學生降溫",
+}
+FILLERS = {"嗯", "嗯嗯", "好", "好的", "喔", "哦", "是", "對", "ok", "okay"}
+
+_ACTION = re.compile(r"[(（][^)）]*[)）]")
+_PUNCTUATION = re.compile(r"[\s\W_]+")
+_JSON_OBJECT = re.compile(r"\{.*\}", re.S)
+
+SCORER_PROMPT = f"""
+You are an expert in trauma-informed practice in schools, rating how a teacher responds to a student in a role-play.
+Rate ONLY the teacher's message, using the student's previous message as context.
+Score each criterion from 0 (absent or violated) to {MAX_SCORE} (clearly demonstrated):
+{chr(10).join(f"- {key}: {text}" for key, text in RUBRIC.items())}
+Reply with a single JSON object and nothing else, for example:
+{{{", ".join(f'"{key}": 1' for key in RUBRIC)}, "comment": "一句繁體中文的評語"}}
+"""
+
+
+def trivial_reason(text):
+    """本機預先篩選：不需要評分的訊息回傳原因，需要評分時回傳 None"""
+    spoken = _ACTION.sub("", text)
+    words = _PUNCTUATION.sub("", spoken).lower()
+    if not words:
+        return "只有動作描述"
+    if words in FILLERS:
+        return "單純附和"
+    if len(words) < MIN_SCORABLE_CHARS:
+        return "太短"
+    return None
+
+
+def collect_turns(rows):
+    """每一則老師訊息一筆，附上前一句學生的話"""
+    items = []
+    for _, values in rows:
+        record = sheets_store.parse_row(values)
+        student = ""
+        for i, turn in enumerate(record["turns"]):
+            if turn["role"] == "assistant":
+                student = turn["content"]
+                continue
+            items.append({
+                "session_id": record["session_id"],
+                "user_id": record["user_id"],
+                "variant": record["persona"].get("variant", ""),
+                "turn": i,
+                "student": student,
+                "teacher": turn["content"],
+            })
+    return items
+
+
+def item_key(item):
+    return f"{item['session_id']}#{item['turn']}"
+
+
+def parse_scores(text):
+    """模型回應中的 JSON 轉成 {規準: 分數, "comment": 評語}；格式不對時丟出 ValueError"""
+    match = _JSON_OBJECT.search(text)
+    if not match:
+        raise ValueError(f"評分回應不是 JSON：{text[:80]}")
+    data = json.loads(match.group(0))
+    scores = {key: max(0, min(MAX_SCORE, int(data[key]))) for key in RUBRIC}
+    scores["comment"] = str(data.get("comment", ""))
+    return scores
+
+
+class RateLimiter:
+    """所有執行緒共用的請求速度上限 (每分鐘 rpm 個，平均分散)"""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Checkpoint:
+    """進度檔 (JSONL，每行一則的評分結果)；多個執行緒同時寫入，每寫一行就存檔"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        results = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        results[result["key"]] = result
+        except FileNotFoundError:
+            pass
+        return results
+
+    def append(self, result):
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def score_item(item, model_name, api_keys, key_cycle, limiter, timeout=chat_engine.ATTEMPT_TIMEOUT):
+    """請模型評一則；失敗時換下一把 Key，全部失敗就丟出最後一個錯誤"""
+    text = f"Student: {item['student'] or '(尚未開口)'}\nTeacher: {item['teacher']}"
+    registry = key_registry.get_registry()
+    last_error = None
+    for _ in range(len(api_keys)):
+        api_key = api_keys[next(key_cycle) % len(api_keys)]
+        limiter.wait()
+        registry.record(api_key)
+        try:
+            reply = chat_engine.call_model(api_key, model_name, SCORER_PROMPT, [], text, timeout=timeout)
+            return parse_scores(reply)
+        except Exception as e:
+            last_error = e
+            if chat_engine.is_quota_error(e):
+                registry.cool_down(api_key)
+    raise last_error
+
+
+def result_table(items, results):
+    header = ["session_id", "user_id", "variant", "turn", "teacher", *RUBRIC, "total", "comment", "skipped", "model"]
+    table = [header]
+    for item in items:
+        result = results.get(item_key(item))
+        if result is None:
+            continue
+        scores = result.get("scores") or {}
+        table.append([
+            item["session_id"], item["user_id"], item["variant"], item["turn"], item["teacher"],
+            *[scores.get(key, "") for key in RUBRIC],
+            sum(scores[key] for key in RUBRIC) if scores else "",
+            scores.get("comment", ""), result.get("skipped", ""), result.get("model", ""),
+        ])
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="依創傷知情規準批次評分研究資料庫中的老師回應")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="評分用的模型")
+    parser.add_argument("--workers", type=int, default=4, help="同時評分的執行緒數")
+    parser.add_argument("--rpm", type=float, default=30, help="所有執行緒合計每分鐘最多幾個請求")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="進度檔 (中斷後重跑會接續)")
+    parser.add_argument("--limit", type=int, default=None, help="這次最多評幾則 (試跑用)")
+    parser.add_argument("--csv", default=None, help="另外把結果存成 CSV")
+    parser.add_argument("--no-write-back", action="store_true", help="不寫回試算表")
+    args = parser.parse_args(argv)
+
+    api_keys = chat_engine.env_api_keys()
+    if not api_keys:
+        return 1
+    if not os.environ.get("GCP_SERVICE_ACCOUNT"):
+        print("❌ 請以環境變數 GCP_SERVICE_ACCOUNT 指定研究資料庫的服務帳戶憑證檔", file=sys.stderr)
+        return 1
+    with open(os.environ["GCP_SERVICE_ACCOUNT"], encoding="utf-8") as f:
+        worksheet = sheets_store.connect(json.load(f))
+
+    items = collect_turns(sheets_store.read_rows(worksheet))
+    checkpoint = Checkpoint(args.checkpoint)
+    results = checkpoint.load()
+    pending = [item for item in items if item_key(item) not in results]
+    print(f"📋 共 {len(items)} 則老師訊息，已完成 {len(items) - len(pending)} 則，這次處理 {len(pending)} 則")
+
+    to_score = []
+    for item in pending:
+        reason = trivial_reason(item["teacher"])
+        if reason:
+            result = {"key": item_key(item), "skipped": reason}
+            checkpoint.append(result)
+            results[result["key"]] = result
+        else:
+            to_score.append(item)
+    to_score = to_score[:args.limit]
+    print(f"⏭️ 本機規則略過 {len(pending) - len(to_score)} 則，交給模型評分 {len(to_score)} 則")
+
+    key_cycle = itertools.count()
+    limiter = RateLimiter(args.rpm)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(score_item, item, args.model, api_keys, key_cycle, limiter): item for item in to_score}
+        for done, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                result = {"key": item_key(item), "scores": future.result(), "model": args.model}
+            except Exception as e:
+                failed += 1
+                print(f"⚠️ {item_key(item)} 評分失敗：{e}", file=sys.stderr)
+                continue
+            checkpoint.append(result)
+            results[result["key"]] = result
+            if done % 20 == 0:
+                print(f"… 已評 {done}/{len(to_score)} 則")
+
+    table = result_table(items, results)
+    if args.csv:
+        import csv
+
+        with open(args.csv, "w", encoding="utf-8-sig", newline="") as f:
+            csv.writer(f).writerows(table)
+        print(f"💾 結果已存成 {args.csv}")
+    if not args.no_write_back:
+        target = sheets_store.get_or_add_worksheet(worksheet, RESULT_WORKSHEET, cols=len(table[0]))
+        target.clear()
+        # 工作表的格數要剛好容納結果 (新建時只有 1000 列，結果更多時 update 會超出範圍)
+        target.resize(rows=len(table), cols=len(table[0]))
+        target.update("A1", table)
+        print(f"☁️ {len(table) - 1} 筆結果已寫回「{RESULT_WORKSHEET}」工作表")
+    if failed:
+        print(f"⚠️ 有 {failed} 則評分失敗，重跑即可補評", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+續談檔讀寫：精簡的 JSON Lines 格式 (含版本與個案設定標頭)，舊版 CSV 紀錄檔仍可讀取。
+
+JSONL 格式：
+    第 1 行 (標頭)：{"format": "trauma-sim-session", "version": 1, "persona": {...}, "turns": N, ...}
+    第 2 行起    ：{"role": "user" | "assistant", "content": "...", "model": "..."}  每行一則對話
+                  (model 只出現在學生回應，記錄實際回應的模型)
+
+系統 Prompt 不寫入檔案 (續談時會用 persona 重新組出)，所以檔案只有純對話內容。
+"""
+import io
+import json
+
+import personas
+
+SESSION_FORMAT = "trauma-sim-session"
+SESSION_VERSION = 1
+
+VALID_ROLES = {"user", "assistant"}
+REQUIRED_PERSONA_KEYS = ("name", "grade", "background", "trigger", "response_mode")
+
+
+def dump_session_jsonl(turns, persona, nickname="", saved_at=""):
+    """把對話紀錄 (不含角色設定 Prompt 的純對話 [{"role", "content", "model"}, ...]) 轉成 JSONL bytes"""
+    header = {
+        "format": SESSION_FORMAT,
+        "version": SESSION_VERSION,
+        "nickname": nickname,
+        "saved_at": saved_at,
+        "turns": len(turns),
+        "persona": persona,
+    }
+    lines = [json.dumps(header, ensure_ascii=False)]
+    lines.extend(json.dumps(_turn_record(msg), ensure_ascii=False) for msg in turns)
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _turn_record(msg):
+    record = {"role": msg["role"], "content": msg["content"]}
+    if msg.get("model"):
+        record["model"] = msg["model"]
+    return record
+
+
+def load_session(data, filename=""):
+    """
+    讀取續談檔，回傳 (persona, turns)。
+    依副檔名判斷格式，.csv 走舊版相容路徑；格式不正確時丟出 ValueError (訊息可直接顯示給學員)。
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if filename.lower().endswith(".csv"):
+        persona, turns = _load_legacy_csv(data)
+    else:
+        persona, turns = _load_jsonl(data)
+    _validate(persona, turns)
+    return persona, turns
+
+
+def _load_jsonl(data):
+    text = data.decode("utf-8-sig")
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError("續談檔是空的。")
+    try:
+        # 一次 json.loads 解析整份檔案，比逐行解析快
+        records = json.loads("[" + ",".join(lines) + "]")
+    except json.JSONDecodeError as e:
+        raise ValueError(f"續談檔格式錯誤：{e.msg}")
+
+    header, turns = records[0], records[1:]
+    if not isinstance(header, dict) or header.get("format") != SESSION_FORMAT:
+        raise ValueError("這不是模擬器的續談檔。")
+    version = header.get("version", 0)
+    if not isinstance(version, int) or isinstance(version, bool):
+        raise ValueError("續談檔的版本號格式錯誤。")
+    if version > SESSION_VERSION:
+        raise ValueError("這個續談檔來自較新版本的模擬器，請更新後再試。")
+    if "turns" in header and header["turns"] != len(turns):
+        raise ValueError(f"續談檔不完整：標頭記錄 {header['turns']} 則對話，實際只有 {len(turns)} 則。")
+    return header.get("persona"), turns
+
+
+def _load_legacy_csv(data):
+    import pandas as pd
+
+    df = pd.read_csv(io.BytesIO(data), encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    if "meta_persona" not in df.columns:
+        raise ValueError("這個 CSV 檔案不包含個案設定資料，無法用於續談。")
+    if df.empty:
+        raise ValueError("這個 CSV 檔案沒有任何對話內容。")
+    try:
+        persona = json.loads(df["meta_persona"].iat[0])
+    except json.JSONDecodeError:
+        raise ValueError("CSV 中的個案設定 (meta_persona) 無法解析。")
+
+    # 略過原本的第一句 prompt，只載入純對話內容 (整欄一次過濾，不逐列 iterrows)
+    dialog = df.loc[~df["content"].str.contains(personas.SYSTEM_PROMPT_MARKER, regex=False), ["role", "content"]]
+    return persona, dialog.to_dict("records")
+
+
+def _validate(persona, turns):
+    if not isinstance(persona, dict):
+        raise ValueError("續談檔缺少個案設定資料，無法用於續談。")
+    missing = [k for k in REQUIRED_PERSONA_KEYS if k not in persona]
+    if missing:
+        raise ValueError(f"個案設定缺少欄位：{', '.join(missing)}")
+    for i, msg in enumerate(turns, 1):
+        if not isinstance(msg, dict) or msg.get("role") not in VALID_ROLES or not isinstance(msg.get("content"), str):
+            raise ValueError(f"第 {i} 則對話格式不正確。")
@@ -0,0 +1,148 @@
+"""
+演練狀態的共用後端 (選用)：每一輪對話後把學員的狀態存一份，換副本或重新連線時接回來。
+
+預設不開啟 (狀態只在各程序的記憶體中)。要在負載平衡後面跑多個副本、或重啟時不想中斷學員時，
+以環境變數 SESSION_STORE 設定：
+    sqlite:///.sessions.db     同一台機器上的程序共用一個 SQLite 檔
+    redis://host:6379/0        跨機器共用 (需安裝 redis 套件)
+SESSION_TTL_HOURS (預設 24) 小時沒有更新的狀態會被清掉。
+
+存的是 JSON (engine.ConversationSession.to_state() 加上畫面需要的欄位)，不含 API Key。
+存取失敗只印出錯誤，不影響演練本身。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_BACKEND = os.environ.get("SESSION_STORE", "")
+SESSION_TTL = float(os.environ.get("SESSION_TTL_HOURS", "24")) * 3600
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class SQLiteSessionStore:
+    """存在 SQLite 檔 (WAL 模式，每個執行緒各自一條連線)；子類別可改用別的資料表與序列化方式 (見 idle_sessions.py)"""
+
+    TABLE = "sessions"
+    STATE_TYPE = "TEXT"
+
+    def __init__(self, path, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} "
+                     f"(session_id TEXT PRIMARY KEY, state {self.STATE_TYPE} NOT NULL, updated REAL NOT NULL)")
+        conn.execute(f"DELETE FROM {self.TABLE} WHERE updated < ?", (time.time() - ttl,))
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _serialize(self, state):
+        return json.dumps(state, ensure_ascii=False)
+
+    def _deserialize(self, data):
+        return json.loads(data)
+
+    def save(self, session_id, state):
+        try:
+            self._conn().execute(
+                f"INSERT INTO {self.TABLE} VALUES (?, ?, ?) ON CONFLICT (session_id) DO UPDATE SET "
+                "state = excluded.state, updated = excluded.updated",
+                (session_id, self._serialize(state), time.time()),
+            )
+            return True
+        except sqlite3.Error as e:
+            print(f"演練狀態存檔失敗: {e}")
+            return False
+
+    def load(self, session_id):
+        try:
+            row = self._conn().execute(
+                f"SELECT state FROM {self.TABLE} WHERE session_id = ? AND updated >= ?",
+                (session_id, time.time() - self.ttl),
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"演練狀態讀取失敗: {e}")
+            return None
+        return self._deserialize(row[0]) if row else None
+
+    def delete(self, session_id):
+        try:
+            self._conn().execute(f"DELETE FROM {self.TABLE} WHERE session_id = ?", (session_id,))
+        except sqlite3.Error as e:
+            print(f"演練狀態刪除失敗: {e}")
+
+
+class RedisSessionStore:
+    def __init__(self, url, ttl=SESSION_TTL, prefix="trauma-sim"):
+        import redis
+
+        self._redis = redis.Redis.from_url(url, socket_timeout=2.0)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, session_id):
+        return f"{self.prefix}:session:{session_id}"
+
+    def save(self, session_id, state):
+        try:
+            self._redis.set(self._key(session_id), json.dumps(state, ensure_ascii=False), ex=int(self.ttl))
+            return True
+        except Exception as e:
+            print(f"演練狀態存檔失敗: {e}")
+            return False
+
+    def load(self, session_id):
+        try:
+            data = self._redis.get(self._key(session_id))
+        except Exception as e:
+            print(f"演練狀態讀取失敗: {e}")
+            return None
+        return json.loads(data) if data else None
+
+    def delete(self, session_id):
+        try:
+            self._redis.delete(self._key(session_id))
+        except Exception as e:
+            print(f"演練狀態刪除失敗: {e}")
+
+
+def open_store(backend=DEFAULT_BACKEND):
+    """依設定字串建立後端；沒有設定或無法開啟時回傳 None (狀態只留在記憶體)"""
+    if not backend:
+        return None
+    try:
+        if backend.startswith("sqlite:///"):
+            return SQLiteSessionStore(backend[len("sqlite:///"):])
+        if backend.startswith(("redis://", "rediss://")):
+            return RedisSessionStore(backend)
+        print(f"不認得的 SESSION_STORE 設定：{backend}")
+    except Exception as e:
+        print(f"無法開啟演練狀態後端 ({backend}): {e}")
+    return None
+
+
+_shared = None
+_opened = False
+_shared_lock = threading.Lock()
+
+
+def get_store():
+    """整個程序共用的後端 (第一次用到時才開啟)；沒有設定時回傳 None"""
+    global _shared, _opened
+    with _shared_lock:
+        if not _opened:
+            _shared = open_store()
+            _opened = True
+        return _shared
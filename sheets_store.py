@@ -0,0 +1,274 @@
+"""
+研究資料庫 (Google Sheets「Simulator」工作表) 的連線、寫入與續談查詢。
+
+欄位配置 (A~G)：
+    A 登入時間 | B 最後更新時間 | C 學員編號 | D 時長(分) | E 累積次數 | F 完整對話 | G 個案設定 (JSON)
+
+為了不要每一輪對話都下載整張表，這裡維護一份「(登入時間, 學員編號) → 列號」的索引，
+只讀 A、C 兩欄建立，新增列時直接更新索引；續談時也只抓符合的那幾列。
+"""
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import personas
+
+SHEET_NAME = "2025創傷知情研習數據"
+WORKSHEET_NAME = "Simulator"
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+LAST_COLUMN = "G"
+INDEX_TTL_SECONDS = 60  # 索引多久重新讀一次 (其他分流/程序也會新增列)
+MISS_REFRESH_SECONDS = 15  # 查不到時，索引至少要讀了這麼久才重新讀 (避免一直查不到的編號每次都重讀兩欄)
+
+# 完整對話欄的格式：「【演練案例】：...」標頭，接著每則訊息為 "[role]: content"
+# 學生回應若記錄了實際使用的模型，寫成 "[assistant@模型名稱]: content"
+_TURN_PATTERN = re.compile(r"^\[(user|assistant)(?:@([^\]\s]+))?\]: ", re.MULTILINE)
+
+_lock = threading.Lock()
+_worksheet = None
+_index = None
+
+
+def connect(creds_dict):
+    """以服務帳戶憑證開啟工作表；同一個程序只授權一次，之後重複使用"""
+    global _worksheet
+    with _lock:
+        if _worksheet is None:
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+
+            creds_dict = dict(creds_dict)
+            if "private_key" in creds_dict:
+                creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+            client = gspread.authorize(creds)
+            _worksheet = client.open(SHEET_NAME).worksheet(WORKSHEET_NAME)
+        return _worksheet
+
+
+def make_session_id(user_id, login_str):
+    # 建立專屬的 Session ID (用登入時間標記這回合對話)
+    return f"{user_id}_{login_str}"
+
+
+class SessionIndex:
+    """(登入時間, 學員編號) → 列號 的索引，附帶每位學員的紀錄清單"""
+
+    def __init__(self, col_logins, col_ids):
+        self.loaded_at = time.time()
+        self.rows = {}        # (login_str, user_id) -> row
+        self.by_session = {}  # session_id -> (login_str, row)
+        self.by_user = {}     # user_id -> [(login_str, row), ...]
+        for i in range(1, len(col_logins)):  # 跳過標題列
+            if i < len(col_ids) and col_logins[i]:
+                self.add(col_logins[i], col_ids[i], i + 1)  # Gspread 索引從 1 開始
+
+    def add(self, login_str, user_id, row):
+        user_id = str(user_id)
+        self.rows[(login_str, user_id)] = row
+        self.by_session[make_session_id(user_id, login_str)] = (login_str, row)
+        self.by_user.setdefault(user_id, []).append((login_str, row))
+
+    def lookup(self, login_str, user_id):
+        return self.rows.get((login_str, str(user_id)))
+
+    def count(self, user_id):
+        return len(self.by_user.get(str(user_id), []))
+
+
+def get_index(worksheet, refresh=False):
+    """取得索引 (只讀 A、C 兩欄)；過期或 refresh=True 時重新讀取"""
+    global _index
+    with _lock:
+        if refresh or _index is None or time.time() - _index.loaded_at > INDEX_TTL_SECONDS:
+            col_logins, col_ids = worksheet.batch_get(["A:A", "C:C"])
+            _index = SessionIndex(_flatten(col_logins), _flatten(col_ids))
+        return _index
+
+
+def _flatten(value_range):
+    return [str(row[0]) if row else "" for row in value_range]
+
+
+def format_header(persona):
+    """完整對話欄的標頭 (演練案例摘要)"""
+    basic_info = f"角色:{persona.get('name','未知')}/觸發:{persona.get('trigger','未知')}"
+    adv_info = f"第{persona.get('session_num',1)}次/關係:{persona.get('relation','未知')}/前情:{persona.get('recent_event','無')}"
+    if persona.get('variant'):
+        adv_info += f"/分流:{persona['variant']}"
+    return f"【演練案例】：{basic_info} | {adv_info}\n\n"
+
+
+def format_turn(role, content, model=None):
+    """完整對話欄中的一則訊息"""
+    if model:
+        role = f"{role}@{model}"
+    return f"[{role}]: {content}\n"
+
+
+def parse_conversation(full_conversation):
+    """把 F 欄的完整對話拆回 [{"role", "content"}, ...]，並略過角色設定 Prompt"""
+    matches = list(_TURN_PATTERN.finditer(full_conversation))
+    turns = []
+    for m, nxt in zip(matches, matches[1:] + [None]):
+        end = nxt.start() if nxt else len(full_conversation)
+        content = full_conversation[m.end():end]
+        if content.endswith("\n"):
+            content = content[:-1]
+        if not turns and personas.SYSTEM_PROMPT_MARKER in content:
+            continue
+        turn = {"role": m.group(1), "content": content}
+        if m.group(2):
+            turn["model"] = m.group(2)
+        turns.append(turn)
+    return turns
+
+
+def read_rows(worksheet, start_row=2, end_row=None):
+    """
+    一次讀回一段列 (預設從第 2 列讀到最後)，回傳 [(列號, [A~G 欄的值]), ...]；空白列略過，缺的欄位補空字串。
+    批次分析用：整段只發一個請求，不逐列讀取。
+    """
+    end = end_row or ""
+    values = worksheet.get(f"A{start_row}:{LAST_COLUMN}{end}")
+    return [(start_row + i, pad_row(v)) for i, v in enumerate(values) if any(v)]
+
+
+def pad_row(values):
+    """API 不會回傳列尾的空白欄位：補成 A~G 七欄"""
+    width = ord(LAST_COLUMN) - ord("A") + 1
+    return list(values) + [""] * (width - len(values))
+
+
+def parse_row(values):
+    """
+    一列紀錄轉成 dict：session_id、login、updated、user_id、persona (舊版紀錄沒有 G 欄時為 {})、
+    turns (由 F 欄拆回，略過角色設定 Prompt)
+    """
+    login_str, updated_str, user_id = str(values[0]), str(values[1]), str(values[2])
+    try:
+        persona = json.loads(values[6]) if values[6] else {}
+    except json.JSONDecodeError:
+        persona = {}
+    return {
+        "session_id": make_session_id(user_id, login_str),
+        "login": login_str,
+        "updated": updated_str,
+        "user_id": user_id,
+        "persona": persona,
+        "turns": parse_conversation(str(values[5])),
+    }
+
+
+def get_or_add_worksheet(worksheet, title, cols):
+    """同一份試算表中的另一張工作表 (分析結果寫回用)；沒有就新增"""
+    import gspread
+
+    try:
+        return worksheet.spreadsheet.worksheet(title)
+    except gspread.WorksheetNotFound:
+        return worksheet.spreadsheet.add_worksheet(title=title, rows=1000, cols=cols)
+
+
+def upsert_session(worksheet, user_id, login_str, logout_str, duration_mins, full_conversation, persona):
+    """寫入一筆對話紀錄：已存在就更新該列，否則新增一列"""
+    user_id = str(user_id)
+    index = get_index(worksheet)
+    row = index.lookup(login_str, user_id)
+    if row is None:
+        # 可能是別的程序剛新增的列，重新讀一次索引再確認
+        index = get_index(worksheet, refresh=True)
+        row = index.lookup(login_str, user_id)
+
+    # 計算累積次數
+    login_count = index.count(user_id) + (0 if row else 1)
+    data_row = [login_str, logout_str, user_id, duration_mins, login_count, full_conversation,
+                json.dumps(persona, ensure_ascii=False)]
+
+    if row:
+        worksheet.update(f"A{row}:{LAST_COLUMN}{row}", [data_row])
+    else:
+        resp = worksheet.append_row(data_row)
+        # 從回應中取得實際寫入的列號 (不自己推算，避免與其他程序同時新增時錯位)
+        m = re.search(r"![A-Z]+(\d+)", resp.get("updates", {}).get("updatedRange", "")) if resp else None
+        if m:
+            with _lock:
+                index.add(login_str, user_id, int(m.group(1)))
+        else:
+            invalidate_index()
+
+
+def invalidate_index():
+    global _index
+    with _lock:
+        _index = None
+
+
+def save_snapshot(worksheet, snapshot):
+    """把一場演練的狀態 (engine.ConversationSession.snapshot()) 寫入工作表"""
+    tw_fix = timedelta(hours=8)
+    start_t = snapshot["start_time"]
+    end_t = snapshot.get("end_time") or datetime.now()
+    login_str = (start_t + tw_fix).strftime("%Y-%m-%d %H:%M:%S")
+    logout_str = (end_t + tw_fix).strftime("%Y-%m-%d %H:%M:%S") # 視為最後更新時間
+    duration_mins = round((end_t - start_t).total_seconds() / 60, 2)
+    upsert_session(worksheet, snapshot["user_id"], login_str, logout_str, duration_mins, snapshot["full_conversation"],
+                   snapshot["persona"])
+
+
+def make_saver(creds_dict):
+    """建立背景自動存檔用的函式；失敗只印出錯誤，不干擾學員"""
+    def save(snapshot):
+        try:
+            save_snapshot(connect(creds_dict), snapshot)
+            return True
+        except Exception as e:
+            print(f"背景上傳失敗: {e}") # 背景報錯不干擾使用者
+            return False
+    return save
+
+
+def find_sessions(worksheet, lookup_id, user_id=None):
+    """
+    以紀錄編號 (Session ID) 或學員編號查詢，回傳 [(session_id, login_str, row), ...]，最新的在前。
+    有給 user_id 時只回傳這位學員自己的紀錄 (學員不能載入別人的對話)。
+    找不到時，若索引已讀了超過 MISS_REFRESH_SECONDS 秒，會重新讀一次索引再查。
+    """
+    lookup_id = str(lookup_id).strip()
+    user_id = None if user_id is None else str(user_id).strip()
+    index = get_index(worksheet)
+    found = _match_sessions(index, lookup_id, user_id)
+    if not found and time.time() - index.loaded_at > MISS_REFRESH_SECONDS:
+        found = _match_sessions(get_index(worksheet, refresh=True), lookup_id, user_id)
+    return found
+
+
+def _match_sessions(index, lookup_id, user_id):
+    if lookup_id in index.by_session:
+        login_str, row = index.by_session[lookup_id]
+        if user_id is not None and lookup_id != make_session_id(user_id, login_str):
+            return []
+        return [(lookup_id, login_str, row)]
+    if user_id is not None and lookup_id != user_id:
+        return []
+    found = [
+        (make_session_id(lookup_id, login_str), login_str, row)
+        for login_str, row in index.by_user.get(lookup_id, [])
+    ]
+    return sorted(found, key=lambda x: x[1], reverse=True)
+
+
+def fetch_session(worksheet, row):
+    """只讀取指定列，回傳 (persona, turns)；舊版紀錄沒有 G 欄時丟出 ValueError"""
+    values = worksheet.get(f"A{row}:{LAST_COLUMN}{row}")
+    values = values[0] if values else []
+    if len(values) < 7 or not values[6]:
+        raise ValueError("這筆紀錄是舊版格式，沒有個案設定資料，無法續談。")
+    try:
+        persona = json.loads(values[6])
+    except json.JSONDecodeError:
+        raise ValueError("這筆紀錄的個案設定無法解析。")
+    return persona, parse_conversation(values[5])